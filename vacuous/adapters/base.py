@@ -1,11 +1,28 @@
+import threading
+from itertools import islice
+
 from django.db.models.signals import post_save, post_init, pre_delete
 from django.db.models import Q
+from django.db import transaction
 
 from vacuous.backends import load_backend
 from vacuous.exceptions import FileDoesNotExist, BranchDoesNotExist
 from vacuous.signals import post_sync
 
 _adapters = set()
+_local = threading.local()
+
+
+class suppress_post_save(object):
+    """
+    Saves and deletes inside this block only update the adapter state, they
+    are not compared against the repository or written back to it.
+    """
+    def __enter__(self):
+        _local.suppressed = getattr(_local, 'suppressed', 0) + 1
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _local.suppressed -= 1
 
 def iter_adapters(flavor=None):
     from django.db.models.loading import get_models
@@ -67,6 +84,9 @@ class AdapterBase(type):
 
     def post_save(cls, sender, **kwargs):
         obj, created = kwargs['instance'], kwargs['created']
+        if getattr(_local, 'suppressed', 0):
+            cls.update_state(obj)
+            return
         adapter = cls(obj)
         if not adapter.is_active():
             return
@@ -97,6 +117,8 @@ class AdapterBase(type):
 
 
     def pre_delete(cls, sender, **kwargs):
+        if getattr(_local, 'suppressed', 0):
+            return
         adapter = cls(kwargs['instance'])
         if adapter.is_active():
             adapter.delete()
@@ -107,11 +129,135 @@ class AdapterBase(type):
     def filter(cls, queryset, paths=None, branch=None):
         raise NotImplementedError()
 
-    def iter_objects(cls, paths=None, branch=None):
+    def iter_objects(cls, paths=None, branch=None, chunk_size=None):
         for model in cls.models:
-            for obj in cls.filter(model.objects.all(), paths=paths, branch=branch):
-                yield obj
+            queryset = cls.filter(model.objects.all(), paths=paths, branch=branch)
+            if chunk_size is None:
+                for obj in queryset:
+                    yield obj
+                continue
+            # page by primary key, so large tables are never loaded at once
+            queryset = queryset.order_by('pk')
+            last_pk = None
+            while True:
+                chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+                chunk = list(chunk[:chunk_size])
+                for obj in chunk:
+                    yield obj
+                if len(chunk) < chunk_size:
+                    break
+                last_pk = chunk[-1].pk
                 
+    def owns_path(cls, path):
+        """
+        Whether `checkout()` may create an object for the file at `path`. An
+        adapter owns every path of a branch it doesn't share with another
+        adapter, adapters sharing a branch have to override this.
+        """
+        key = (cls.flavor, cls.repo, cls.branch)
+        for adapter in _adapters:
+            if adapter is not cls and (adapter.flavor, adapter.repo, adapter.branch) == key:
+                return False
+        return True
+
+    def new_object(cls, path):
+        # adapters for several models have to decide which one to create
+        if len(cls.models) != 1:
+            return None
+        return iter(cls.models).next()()
+
+    def checkout(cls, revision=None, batch_size=500):
+        """
+        Loads every file of `revision` (the head of the adapter's branch by
+        default) into the database. The tree is walked once and objects are
+        saved in one transaction per batch, `post_sync` is sent once per
+        model and batch with the saved objects as `instances`. Objects are
+        only created for the paths the adapter `owns_path()`.
+        """
+        for name in ('flavor', 'repo', 'branch'):
+            if not isinstance(getattr(cls, name), basestring):
+                raise TypeError("%s.checkout() needs a class-level `%s`" % (cls.__name__, name))
+        backend = load_backend(cls.flavor, cls.repo)
+        commit = backend.revision(revision, branch=cls.branch)
+        files = backend.iter_files(revision=commit.revision)
+        while True:
+            batch = dict(islice(files, batch_size))
+            if not batch:
+                break
+            cls._checkout_batch(commit, batch)
+        return commit
+
+    def _checkout_batch(cls, commit, files):
+        synced = {}
+        def save(adapter, data):
+            adapter.set_data(data.decode(adapter.get_encoding()))
+            adapter.set_revision(commit.revision)
+            adapter.obj.save()
+            synced.setdefault(type(adapter.obj), []).append(adapter.obj)
+
+        with transaction.commit_on_success():
+            with suppress_post_save():
+                missing = set(files)
+                for obj in cls.iter_objects(paths=files.keys(), branch=cls.branch):
+                    adapter = cls(obj)
+                    path = adapter.get_path()
+                    if path in files:
+                        missing.discard(path)
+                        save(adapter, files[path])
+                for path in missing:
+                    if not cls.owns_path(path):
+                        continue
+                    obj = cls.new_object(path)
+                    if obj is not None:
+                        adapter = cls(obj)
+                        adapter.set_path(path)
+                        save(adapter, files[path])
+
+        for model, instances in synced.iteritems():
+            post_sync.send_robust(sender=model, adapter=cls, instances=instances, commit=commit)
+
+    def sync_paths(cls, repo, branch, commits, deleted=(), batch_size=100, **info):
+        """
+        Loads the objects at the paths in `commits` from the commit mapped to
+        their path and deletes the objects at `deleted` paths. Only objects
+        that belong to `branch` of `repo` are touched. Objects are streamed
+        from the database and saved in one transaction per batch.
+        `post_sync` is sent once per model with the synced `instances`, the
+        paths that `failed` and any extra `info`.
+        """
+        synced, failed = {}, []
+        objects = cls.iter_objects(paths=commits.keys(), branch=branch, chunk_size=batch_size)
+        while True:
+            batch = list(islice(objects, batch_size))
+            if not batch:
+                break
+            with transaction.commit_on_success():
+                with suppress_post_save():
+                    for obj in batch:
+                        adapter = cls(obj)
+                        if adapter.repo != repo or adapter.branch != branch:
+                            continue
+                        try:
+                            adapter.load(commits[adapter.path].revision)
+                        except (FileDoesNotExist, KeyError), e:
+                            failed.append((adapter.path, e))
+                            continue
+                        obj.save()
+                        synced.setdefault(type(obj), []).append(obj)
+
+        if deleted:
+            # the files are gone already, don't queue their deletion again
+            with transaction.commit_on_success():
+                with suppress_post_save():
+                    for obj in cls.iter_objects(paths=list(deleted), branch=branch, chunk_size=batch_size):
+                        adapter = cls(obj)
+                        if adapter.repo == repo and adapter.branch == branch:
+                            obj.delete()
+
+        for model in cls.models:
+            post_sync.send_robust(sender=model, adapter=cls, instances=synced.get(model, []), failed=failed, **info)
+        return failed
+
     def proxy(cls, attr):
         return property(
             lambda self: getattr(self.obj, attr), 
@@ -200,5 +346,5 @@ class Adapter(object):
             commit=commit,
         )
     
-    def history(self):
-        return self.get_backend().history(path=self.path)
+    def history(self, **kwargs):
+        return self.get_backend().history(path=self.path, **kwargs)
@@ -4,8 +4,8 @@ import hashlib
 from django.utils.functional import wraps
 
 from vacuous.exceptions import FileDoesNotExist
-from vacuous.constants import WRITE, RENAME, DELETE
-from vacuous.tasks import CommitTask
+from vacuous.constants import WRITE, RENAME, DELETE, BLOB
+from vacuous.executors import get_commit_executor
 
 
 class CommitOnSuccess(object):
@@ -60,7 +60,11 @@ class BaseBackend(object):
         encoding = kwargs.pop('encoding', self.default_encoding)
         if encoding:
             data = data.encode(encoding)
-        self.changes[path] = (WRITE, data)
+        blob_id = self.store_blob(data)
+        if blob_id is None:
+            self.changes[path] = (WRITE, data)
+        else:
+            self.changes[path] = (BLOB, blob_id)
 
     def delete(self, path):
         self.changes[path] = (DELETE, None)
@@ -78,13 +82,13 @@ class BaseBackend(object):
         if not self.is_dirty() and not force:
             return
         kwargs['message'] = message
+        kwargs['force'] = force
         kwargs.setdefault('branch', self.default_branch)
-        result = CommitTask.apply_async(
-            args=[self.flavor, self.path, self.changes, kwargs],
-            routing_key='vacuous.repo.%s.commit' % self.flavor,
-        )
-        self.changes.clear()
-        return result.wait()
+        self.flush_blobs()
+        try:
+            return get_commit_executor().commit(self.flavor, self.path, self.changes, kwargs)
+        finally:
+            self.changes.clear()
         
     def read(self, path, **kwargs):
         encoding = kwargs.pop('encoding', self.default_encoding)
@@ -94,18 +98,72 @@ class BaseBackend(object):
         return data
     
     ## backend specific
+
+    def store_blob(self, data):
+        # backends that can write blobs ahead of the commit return their id
+        return None
+
+    def flush_blobs(self):
+        pass
     
-    def history(self, path=None, revision=None, branch=None):
+    def history(self, *args, **kwargs):
+        return list(self.iter_history(*args, **kwargs))
+        
+    def iter_history(self, path=None, revision=None, branch=None, since_revision=None, since=None, offset=0, limit=None, after=None):
         raise NotImplementedError
         
     def revision(self, revision=None, branch=None):
         raise NotImplementedError
 
+    def iter_files(self, revision=None, branch=None):
+        raise NotImplementedError
+
+    def is_ancestor(self, ancestor, revision):
+        raise NotImplementedError
+
+    def merge_base(self, a, b):
+        raise NotImplementedError
+
+    def sync_plan(self, oldrev, newrev):
+        """
+        Returns `(changed, deleted)` for bringing the database from `oldrev`
+        (None for an empty database) to `newrev`: `changed` maps the paths
+        that exist in `newrev` to the newest commit that touched them,
+        `deleted` holds the paths that are gone.
+        """
+        since_revision = None
+        if oldrev:
+            base = self.merge_base(oldrev, newrev)
+            since_revision = base and base.revision
+        changed = {}
+        for commit in self.history(revision=newrev, since_revision=since_revision):
+            for path in commit.paths:
+                changed.setdefault(path, commit)
+        deleted = set()
+        for path in changed.keys():
+            try:
+                self.do_read(path, revision=newrev)
+            except FileDoesNotExist:
+                deleted.add(path)
+                del changed[path]
+        return changed, deleted
+
     def do_read(self, path, **kwargs):
         raise NotImplementedError
 
     def do_commit(self, message='', **kwargs):
         raise NotImplementedError
+
+    def import_files(self, files, message='', author=None, committer=None, branch=None, progress=None):
+        raise NotImplementedError
+
+    def do_commit_group(self, changesets, branch=None, parent=None):
+        commits = []
+        for changes, kwargs in changesets:
+            self.changes = changes
+            commits.append(self.do_commit(branch=branch, parent=parent, **kwargs))
+            parent = None
+        return commits
     
     def create_branch(self, name, revision=None):
         raise NotImplementedError
@@ -121,6 +179,12 @@ class BaseBackend(object):
         
     def init_repo(self):
         raise NotImplementedError
+
+    def needs_maintenance(self):
+        return False
+
+    def maintain(self):
+        pass
         
     def delete_repo(self):
         raise NotImplementedError
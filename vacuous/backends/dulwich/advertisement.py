@@ -0,0 +1,92 @@
+import os
+import hashlib
+from StringIO import StringIO
+
+from django.conf import settings
+from django.core.cache import cache
+
+from dulwich.protocol import ReceivableProtocol
+from dulwich.server import DEFAULT_HANDLERS
+
+from vacuous.backends.dulwich.utils import WebBackend
+
+ADVERTISEMENT_TIMEOUT = getattr(settings, 'VACUOUS_REFS_CACHE_TIMEOUT', 3600)
+
+
+def _version_key(backend):
+    return 'vacuous.refs.%s' % hashlib.sha1(backend.path).hexdigest()
+
+
+def _read_file(path):
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return ''
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+def get_refs_version(backend):
+    """
+    Returns a hash of the refs of `backend` as they are on disk: HEAD,
+    packed-refs and every loose ref. Every process derives the same version
+    from the same refs, so the version doesn't depend on a shared cache and
+    picks up refs changed outside of vacuous right away.
+    """
+    controldir = backend.repo.controldir()
+    version = hashlib.sha1()
+    for name in ('HEAD', 'packed-refs'):
+        version.update('%s\0%s\0' % (name, _read_file(os.path.join(controldir, name))))
+    for root, dirs, files in os.walk(os.path.join(controldir, 'refs')):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith('.lock'):
+                continue
+            path = os.path.join(root, name)
+            version.update('%s\0%s\0' % (os.path.relpath(path, controldir), _read_file(path)))
+    return version.hexdigest()
+
+
+def render_advertisement(backend, service=None):
+    repo = backend.repo
+    out = StringIO()
+    if service:
+        proto = ReceivableProtocol(StringIO().read, out.write)
+        handler = DEFAULT_HANDLERS[service](WebBackend(), [backend], proto, stateless_rpc=True, advertise_refs=True)
+        handler.proto.write_pkt_line('# service=%s\n' % service)
+        handler.proto.write_pkt_line(None)
+        handler.handle()
+    else:
+        refs = repo.get_refs()
+        for name in sorted(refs.iterkeys()):
+            if name == 'HEAD':
+                continue
+            hexsha = refs[name]
+            o = repo[hexsha]
+            if not o:
+                continue
+            out.write('%s\t%s\n' % (hexsha, name))
+            peeled_sha = repo.get_peeled(name)
+            if peeled_sha != hexsha:
+                out.write('%s\t%s^{}\n' % (peeled_sha, name))
+    return out.getvalue()
+
+
+def get_advertisement(backend, service=None):
+    """
+    Returns `(etag, data)` for the ref advertisement of `backend`: the smart
+    pkt-line form for `service`, or the dumb info/refs form if `service` is
+    None.
+    """
+    # read the version first, so an advertisement rendered from refs that
+    # change meanwhile is stored under the outdated version
+    version = get_refs_version(backend)
+    key = '%s.%s.%s' % (_version_key(backend), version, service or 'dumb')
+    cached = cache.get(key)
+    if cached is None:
+        data = render_advertisement(backend, service)
+        cached = (hashlib.sha1(data).hexdigest(), data)
+        cache.set(key, cached, ADVERTISEMENT_TIMEOUT)
+    return cached
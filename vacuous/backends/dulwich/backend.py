@@ -1,19 +1,29 @@
 import os
 import stat
+import errno
 import time
 import shutil
 import datetime
-from operator import itemgetter, attrgetter
+from operator import itemgetter
+from itertools import islice, dropwhile
+
+from django.conf import settings
 
 from dulwich.objects import Commit, Blob, Tree
 from dulwich.repo import Repo
 
 from vacuous.backends.base import BaseBackend
-from vacuous.exceptions import FileDoesNotExist, BranchDoesNotExist, BranchDoesAlreadyExist, CommitDoesNotExist
-from vacuous.constants import WRITE, RENAME, DELETE
+from vacuous.exceptions import FileDoesNotExist, BranchDoesNotExist, BranchDoesAlreadyExist, CommitDoesNotExist, CommitConflict
+from vacuous.constants import WRITE, RENAME, DELETE, BLOB
 
-from vacuous.backends.dulwich.utils import clean_path, iter_blob_paths, tree_diff, get_by_path, is_same_object
-from vacuous.backends.dulwich.commit import DulwichCommit
+from vacuous.backends.dulwich.utils import clean_path, iter_blob_paths, tree_diff, lookup_path, copy_tree
+from vacuous.backends.dulwich.cache import tree_entry_cache, CachedObjectStore
+from vacuous.backends.dulwich.commit import DulwichCommit, make_timestamp
+from vacuous.backends.dulwich.index import get_path_index, changed_paths
+from vacuous.backends.dulwich.graph import get_commit_graph
+from vacuous.backends.dulwich.pool import repo_pool
+from vacuous.backends.dulwich.pack import PackWriter
+from vacuous.backends.dulwich import maintenance
 
 
 class Backend(BaseBackend):
@@ -21,24 +31,61 @@ class Backend(BaseBackend):
     null_revision = 'null'
     file_mode = 0100644
     directory_mode = 040755
+    # commits writing at least this many objects are written as a single pack
+    pack_threshold = getattr(settings, 'VACUOUS_PACK_THRESHOLD', 64)
+    # how often a commit is replayed on top of a branch that moved concurrently
+    commit_retries = getattr(settings, 'VACUOUS_COMMIT_RETRIES', 5)
+
+    def __init__(self, *args, **kwargs):
+        super(Backend, self).__init__(*args, **kwargs)
+        self.blobs = {}
 
     @property
     def repo(self):
         if not hasattr(self, '_repo'):
-            self._repo = Repo(self.path)
+            self._repo = repo_pool.acquire(self.path, self)
         return self._repo
+
+    @property
+    def objects(self):
+        if not hasattr(self, '_objects'):
+            self._objects = CachedObjectStore(self.repo)
+        return self._objects
+
+    @property
+    def path_index(self):
+        return get_path_index(self.repo)
+
+    @property
+    def commit_graph(self):
+        return get_commit_graph(self.repo)
+
+    def update_indexes(self, heads):
+        changes = {}
+        self.commit_graph.update(self.objects, heads, changes)
+        self.path_index.update(self.objects, heads, changes)
         
+    def _reload_refs(self):
+        # the refs container caches packed-refs, which maintenance may have
+        # rewritten meanwhile in this or another process
+        self.repo.refs._packed_refs = None
+
     def _get_commit(self, revision=None, branch=None):
         repo = self.repo
         if not revision:
             try:
                 revision = repo.refs['refs/heads/%s' % branch]
             except KeyError:
-                raise BranchDoesNotExist(self, branch)
+                # the loose ref may have been packed since packed-refs was read
+                self._reload_refs()
+                try:
+                    revision = repo.refs['refs/heads/%s' % branch]
+                except KeyError:
+                    raise BranchDoesNotExist(self, branch)
         elif isinstance(revision, DulwichCommit):
             revision = revision.revision
         try:
-            commit = repo[revision]
+            commit = self.objects[revision]
             if not isinstance(commit, Commit):
                 raise CommitDoesNotExist(self, revision)
             return commit
@@ -48,23 +95,52 @@ class Backend(BaseBackend):
     def _collect(self, tree, path, cache=None):
         result = [(None, None, tree)]
         bits = filter(None, path.split(os.path.sep))
-        repo = self.repo
         for i, bit in enumerate(bits):
-            found = False
-            for mode, name, hexsha in tree.items():
-                if name == bit:
-                    found = True
-                    if cache and hexsha in cache:
-                        tree = cache[hexsha]
-                    else:
-                        tree = repo[hexsha]
-                    result.append((mode, name, tree))
-                    break
-            if not found:
+            if bit not in tree:
                 result += [(self.directory_mode, bit, Tree()) for bit in bits[i:]]
                 break
+            mode, hexsha = tree[bit]
+            if cache and hexsha in cache:
+                tree = cache[hexsha]
+            else:
+                # cached objects are shared, so copy trees before they get modified
+                tree = self.objects[hexsha]
+                if isinstance(tree, Tree):
+                    tree = copy_tree(tree)
+            result.append((mode, bit, tree))
         return result
         
+    def _store(self, objects, pack=False):
+        object_store = self.repo.object_store
+        if not pack and len(objects) < self.pack_threshold:
+            for obj in objects:
+                object_store.add_object(obj)
+            return
+        writer = PackWriter(object_store)
+        try:
+            for obj in objects:
+                if obj.id not in object_store:
+                    writer.add(obj)
+        except:
+            writer.abort()
+            raise
+        writer.commit()
+
+    def store_blob(self, data):
+        blob = Blob.from_string(data)
+        self.blobs[blob.id] = blob
+        return blob.id
+
+    def flush_blobs(self):
+        # blobs that got overwritten before the commit are never stored
+        referenced = set(data for action, data in self.changes.itervalues() if action == BLOB)
+        self._store([blob for blob_id, blob in self.blobs.iteritems() if blob_id in referenced])
+        self.blobs.clear()
+
+    def rollback(self):
+        super(Backend, self).rollback()
+        self.blobs.clear()
+
     def _link(self, seq):
         cache = {}
         for i in xrange(len(seq) - 1, -1, -1):
@@ -80,10 +156,25 @@ class Backend(BaseBackend):
         if os.path.exists(self.path):
             return
         os.mkdir(self.path)
-        self._repo = Repo.init_bare(self.path)
+        Repo.init_bare(self.path)
         
+    def _discard_repo(self):
+        repo_pool.discard(self.path)
+        for attr in ('_repo', '_objects'):
+            if hasattr(self, attr):
+                delattr(self, attr)
+
     def delete_repo(self):
+        self._discard_repo()
         shutil.rmtree(self.path)
+
+    def needs_maintenance(self):
+        return maintenance.needs_maintenance(self.repo)
+
+    def maintain(self):
+        maintenance.maintain(self.repo)
+        # the refs container caches packed-refs, start over with a fresh handle
+        self._discard_repo()
         
     ### branches ###
 
@@ -96,6 +187,9 @@ class Backend(BaseBackend):
         self.repo.refs['refs/heads/%s' % name] = self._get_commit(revision, 'master').id
         
     def delete_branch(self, name):
+        # dulwich only removes the packed entry if packed-refs was read
+        self._reload_refs()
+        self.repo.refs.get_packed_refs()
         try:
             del self.repo.refs['refs/heads/%s' % name]
         except KeyError:
@@ -111,13 +205,86 @@ class Backend(BaseBackend):
         self.create_branch(new_name, 'refs/heads/%s' % old_name)
         self.delete_branch(old_name)
     
+    ### ancestry ###
+
+    def _get_commit_id(self, revision):
+        if isinstance(revision, DulwichCommit):
+            revision = revision.revision
+        if revision not in self.commit_graph:
+            revision = self._get_commit(revision).id
+            self.update_indexes([revision])
+        return revision
+
+    def is_ancestor(self, ancestor, revision):
+        return self.commit_graph.is_ancestor(self._get_commit_id(ancestor), self._get_commit_id(revision))
+
+    def merge_base(self, a, b):
+        commit_id = self.commit_graph.merge_base(self._get_commit_id(a), self._get_commit_id(b))
+        if commit_id:
+            return self.revision(commit_id)
+        return None
+
+    def touches(self, revision, path):
+        commit_id = self._get_commit_id(revision)
+        path = clean_path(path)
+        if not self.commit_graph.maybe_touches(commit_id, path):
+            return False
+        return path in changed_paths(self.objects, self.objects[commit_id])
+
+    def sync_plan(self, oldrev, newrev):
+        new = self._get_commit(newrev)
+        old_tree = None
+        if oldrev:
+            try:
+                old_tree = self._get_commit(oldrev).tree
+            except CommitDoesNotExist:
+                pass
+
+        # one diff of the trees, identical subtrees are skipped entirely
+        objects = self.objects
+        changed, deleted = {}, set()
+        for path in tree_diff(objects, new.tree, old_tree):
+            entry = lookup_path(objects, new.tree, path)
+            if entry and stat.S_ISREG(entry[0]):
+                changed[path] = None
+            else:
+                deleted.add(path)
+
+        # attribute each path to the newest commit that touched it, in a
+        # single walk restricted to the commits the path index knows about
+        self.update_indexes([new.id])
+        graph = self.commit_graph
+        owners = {}
+        for path in changed:
+            for commit_id in self.path_index.paths.get(path, ()):
+                owners.setdefault(commit_id, []).append(path)
+        pending = len(changed)
+        if owners:
+            min_generation = min(graph.generation(commit_id) for commit_id in owners)
+            for commit_id in graph.walk([new.id], min_generation=min_generation):
+                if not pending:
+                    break
+                for path in owners.get(commit_id, ()):
+                    if changed[path] is None:
+                        changed[path] = commit_id
+                        pending -= 1
+
+        commits = {}
+        for path, commit_id in changed.iteritems():
+            # paths that only changed on the old side are attributed to the head
+            commit_id = commit_id or new.id
+            if commit_id not in commits:
+                commits[commit_id] = DulwichCommit(self, objects[commit_id])
+            changed[path] = commits[commit_id]
+        return changed, deleted
+
     ### api ###
     
     def revision(self, revision=None, branch='master'):
         return DulwichCommit(self, self._get_commit(revision, branch))
         
     def _walk(self, path, tree):
-        repo = self.repo
+        objects = self.objects
         blobs, subtrees = [], []
         for mode, name, hexsha in tree.items():
             if stat.S_ISREG(mode):
@@ -127,112 +294,119 @@ class Backend(BaseBackend):
         yield (path, subtrees, blobs)
         for name in subtrees:
             mode, hexsha = tree[name]
-            for t in self._walk(os.path.join(path, name), repo[hexsha]):
+            for t in self._walk(os.path.join(path, name), objects[hexsha]):
                 yield t
         
     def walk(self, path, revision=None, branch='master'):
-        root = repo[self._get_commit(revision, branch).tree]
+        root = self.objects[self._get_commit(revision, branch).tree]
         return self._walk(path, root)
     
-    def history(self, path=None, revision=None, branch='master', since_revision=None, since=None, sort=True):
+    def iter_files(self, revision=None, branch='master'):
+        objects = self.objects
+        pending = [('', self._get_commit(revision, branch).tree)]
+        while pending:
+            path, tree_id = pending.pop()
+            for mode, name, hexsha in objects[tree_id].items():
+                if stat.S_ISREG(mode):
+                    yield os.path.join(path, name), objects[hexsha].as_pretty_string()
+                elif stat.S_ISDIR(mode):
+                    pending.append((os.path.join(path, name), hexsha))
+
+    def iter_history(self, path=None, revision=None, branch='master', since_revision=None, since=None, offset=0, limit=None, after=None):
         if revision == self.null_revision:
-            return []
+            return iter([])
 
         if path is not None:
             path = clean_path(path)
         
+        since_time = since and make_timestamp(since)
         if since_revision:
-            ctime = self.revision(since_revision).commit_time
-            if since:
-                since = max(ctime, since)
-            else:
-                since = ctime
+            since_revision = self._get_commit(since_revision).id
+            self.update_indexes([since_revision])
+            since_time = max(since_time, self.commit_graph.commit_time(since_revision))
                 
         if revision or branch:
-            pending = set([self._get_commit(revision, branch).id])
+            heads = [self._get_commit(revision, branch).id]
         else:
-            pending = set(self._repo.get_refs().values())
+            heads = self.repo.get_refs().values()
 
-        visited = set()
-        result = []
-        repo = self.repo
-
-        while pending:
-            commit_id = pending.pop()
-            commit = self.revision(commit_id)
-            
-            if commit_id in visited:
-                continue
-            visited.add(commit_id)
-            
-            if since and since > commit.commit_time:
-                continue
+        self.update_indexes(heads)
+        if after:
+            # a cursor outside of this history would skip every commit
+            after = self._get_commit_id(after)
+            graph = self.commit_graph
+            if (since_time and graph.commit_time(after) < since_time
+                    or path and after not in self.path_index.paths.get(path, ())
+                    or not any(graph.is_ancestor(after, head) for head in heads)):
+                raise CommitDoesNotExist(self, "%s is not in this history" % after)
+        if path:
+            commit_ids = self.path_index.iter_history(self.commit_graph, heads, path, since_revision=since_revision, since_time=since_time)
+        else:
+            commit_ids = self.commit_graph.walk(heads, since_revision=since_revision, since_time=since_time)
 
-            if commit_id != since_revision:
-                pending.update(commit._commit.parents)
-                
-            if path:
-                tree = repo[commit._commit.tree]
-                found = False
-                parents = commit._commit.parents
-                for parent in parents:
-                    parent_tree = repo[repo[parent].tree]
-                    if not is_same_object(repo, tree, parent_tree, path):
-                        found = True
-                        break
-                if not parents and get_by_path(repo, tree, path):
-                    found = True
-                if not found:
-                    continue
-            result.append(commit)
-        if sort:
-            result.sort(key=attrgetter('commit_time'), reverse=True)
-        return result
+        # skip on ids, so commit objects are only read for the returned page
+        if after:
+            commit_ids = dropwhile(lambda commit_id: commit_id != after, commit_ids)
+            offset += 1
+        commit_ids = islice(commit_ids, offset, offset + limit if limit is not None else None)
+        return (DulwichCommit(self, self.objects[commit_id]) for commit_id in commit_ids)
         
     def do_read(self, path, revision=None, branch='master'):
         path = clean_path(path)
-        repo = self.repo
+        objects = self.objects
         if revision == self.null_revision:
             raise FileDoesNotExist(self, "'%s' does not exist at revision null" % path)
         c = self._get_commit(revision, branch)
-        obj = get_by_path(repo, repo[c.tree], path)
-        if not obj:
+        entry = lookup_path(objects, c.tree, path)
+        if not entry:
             raise FileDoesNotExist(self, "'%s' does not exist" % path)
-        if not isinstance(obj, Blob):
+        if not stat.S_ISREG(entry[0]):
             raise FileDoesNotExist(self, "'%s' is not a regular file" % path)
-        data = obj.as_pretty_string()
+        data = objects[entry[1]].as_pretty_string()
         return data
         
-    def do_commit(self, message='', author=None, committer=None, branch='master', parent=None):
-        if isinstance(message, unicode):
-            message = message.encode('utf-8')
-        repo = self.repo
-        try:
-            parent = self._get_commit(parent, branch)
-            root = repo[parent.tree]
-        except BranchDoesNotExist:
-            if branch == 'master': # initial commit
-                root = Tree()
-            else:
-                raise
-            
-        cache = {}
+    def _forget_entries(self, entries, path):
+        # everything below `path` was replaced or removed
+        prefix = path + os.path.sep
+        for key in [key for key in entries if key.startswith(prefix)]:
+            del entries[key]
+
+    def _apply(self, root, changes, cache, entries):
+        """
+        Applies `changes` to `root` and records the resulting entry for each
+        changed path in `entries`. Returns the changed paths and new blobs.
+        """
         paths = set()
-        objects = set()
-        
-        for path, (action, data) in self.changes.iteritems():
+        blobs = []
+        for path, (action, data) in changes.iteritems():
             path = clean_path(path)
-            paths.add(path)
             dirname, filename = os.path.split(path)
             trees = self._collect(root, dirname, cache)
+            if filename in trees[-1][2] and stat.S_ISDIR(trees[-1][2][filename][0]):
+                self._forget_entries(entries, path)
 
-            if action == WRITE:
-                blob = Blob.from_string(data)
-                trees[-1][2][filename] = (self.file_mode, blob.id)
-                cache[blob.id] = blob
+            if action in (WRITE, BLOB):
+                if action == WRITE:
+                    # commit_many() takes changes that didn't go through write()
+                    if isinstance(data, unicode):
+                        data = data.encode(self.default_encoding)
+                    blob = Blob.from_string(data)
+                    blob_id = blob.id
+                else:
+                    # written by store_blob() already
+                    blob, blob_id = None, data
+                tree = trees[-1][2]
+                # don't rewrite the trees for content that is already there
+                if filename in tree and tree[filename] == (self.file_mode, blob_id):
+                    continue
+                tree[filename] = (self.file_mode, blob_id)
+                if blob:
+                    blobs.append(blob)
+                entries[path] = (self.file_mode, blob_id)
 
             elif action == DELETE:
                 del trees[-1][2][filename]
+                entries[path] = (None, None)
 
             elif action == RENAME:
                 old = self._collect(root, data, cache)
@@ -241,34 +415,216 @@ class Backend(BaseBackend):
                 trees[-1][2][filename] = (mode, obj.id)
                 cache.update(self._link(old[:-1]))
                 paths.add(data)
+                if stat.S_ISDIR(mode):
+                    self._forget_entries(entries, data)
+                entries[path] = (mode, obj.id)
+                entries[data] = (None, None)
 
+            paths.add(path)
             cache.update(self._link(trees))
-        else:
-            objects.add(root)
+        return paths, blobs
 
-        # collect all objects that have to be committed
-        for path in paths:
-            objects.update([obj for mode, name, obj in self._collect(root, path, cache)])
-            
-        # create the commit
+    def _make_commit(self, tree, parents, message='', author=None, committer=None, commit_time=None):
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
         c = Commit()
-        if parent:
-            c.parents = [parent.id]
-        c.tree = root.id
+        c.parents = parents
+        c.tree = tree
         c.committer = committer or self.committer
         c.author = author or c.committer
 
-        t = time.localtime()
-        c.commit_time = c.author_time = int(time.mktime(t))
-        c.commit_timezone = c.author_timezone = t.tm_isdst * 3600 - time.timezone
+        if commit_time is None:
+            t = time.localtime()
+            c.commit_time = c.author_time = int(time.mktime(t))
+            c.commit_timezone = c.author_timezone = t.tm_isdst * 3600 - time.timezone
+        else:
+            c.commit_time = c.author_time = make_timestamp(commit_time)
+            offset = commit_time.utcoffset()
+            if offset is None:
+                t = time.localtime(c.commit_time)
+                c.commit_timezone = c.author_timezone = t.tm_isdst * 3600 - time.timezone
+            else:
+                c.commit_timezone = c.author_timezone = offset.days * 86400 + offset.seconds
         c.encoding = "UTF-8"
         c.message = message
-        objects.add(c)
+        return c
+
+    def do_commit(self, message='', author=None, committer=None, branch='master', parent=None, force=False):
+        changeset = (self.changes, {'message': message, 'author': author, 'committer': committer, 'force': force})
+        return self.do_commit_group([changeset], branch=branch, parent=parent)[0]
+
+    def _build_commits(self, parent, changesets, pack=False):
+        root = parent and copy_tree(self.objects[parent.tree]) or Tree()
+        cache = {}
+        objects = set()
+        entries = {}
+        paths = set()
+        commits = []
+        results = []
+
+        for i, (changes, kwargs) in enumerate(changesets):
+            kwargs = dict(kwargs)
+            force = kwargs.pop('force', False)
+            changed, blobs = self._apply(root, changes, cache, entries)
+            if parent and not force and root.id == parent.tree:
+                # nothing changed, the caller's content is at the parent already
+                results.append(parent)
+                continue
+            paths.update(changed)
+            objects.update(blobs)
+            # later changesets modify the same trees in place
+            snapshot = i < len(changesets) - 1
+
+            # collect all trees that have to be committed, renamed and
+            # previously stored objects are already on disk
+            for path in changed:
+                for mode, name, tree in self._collect(root, os.path.dirname(path), cache):
+                    objects.add(copy_tree(tree) if snapshot else tree)
+            objects.add(copy_tree(root) if snapshot else root)
+
+            c = self._make_commit(root.id, parent and [parent.id] or [], **kwargs)
+            objects.add(c)
+            commits.append(c)
+            results.append(c)
+            parent = c
 
         # write everything to disk
-        for obj in objects:
-            repo.object_store.add_object(obj)
+        self._store(objects, pack=pack)
+        return commits, results, root, entries, paths
+
+    def _update_ref(self, branch, old, new):
+        name = 'refs/heads/%s' % branch
+        self._reload_refs()
+        try:
+            if old is None:
+                return self.repo.refs.add_if_new(name, new)
+            return self.repo.refs.set_if_equals(name, old, new)
+        except OSError, e:
+            # somebody else holds the lock on the ref
+            if e.errno != errno.EEXIST:
+                raise
+            return False
+
+    def _overlaps(self, old, new, paths):
+        objects = self.objects
+        def lookup(commit, path):
+            return commit and lookup_path(objects, commit.tree, path)
+        for path in paths:
+            if lookup(old, path) != lookup(new, path):
+                return True
+            # writing below a directory that became a file conflicts, too
+            dirname = os.path.dirname(path)
+            while dirname:
+                entry = lookup(new, dirname)
+                if entry and not stat.S_ISDIR(entry[0]) and entry != lookup(old, dirname):
+                    return True
+                dirname = os.path.dirname(dirname)
+        return False
+
+    def do_commit_group(self, changesets, branch='master', parent=None, pack=False):
+        if not parent:
+            self._reload_refs()
+        try:
+            parent = self._get_commit(parent, branch)
+        except BranchDoesNotExist:
+            # only master is created by its initial commit, in an empty repo
+            if branch != 'master' or any(name.startswith('refs/') for name in self.repo.refs.allkeys()):
+                raise
+
+        for attempt in xrange(self.commit_retries):
+            commits, results, root, entries, paths = self._build_commits(parent, changesets, pack)
+            if not commits or self._update_ref(branch, parent and parent.id, commits[-1].id):
+                break
+            # the branch moved, replay the changes on top of it unless they touch the same paths
+            tip = self._get_commit(None, branch)
+            if self._overlaps(parent, tip, paths):
+                raise CommitConflict(self, "concurrent changes to branch '%s' touch the same paths" % branch)
+            if parent and tip.id == parent.id:
+                time.sleep(0.05 * (attempt + 1))
+            parent = tip
+        else:
+            raise CommitConflict(self, "branch '%s' kept changing" % branch)
+
+        # reads at the new head can be answered without walking the tree
+        for path, entry in entries.iteritems():
+            tree_entry_cache[(root.id, path)] = entry
+
+        # keep the indexes current; unindexed history is caught up lazily
+        if commits and (not commits[0].parents or commits[0].parents[0] in self.commit_graph):
+            self.update_indexes([commits[-1].id])
+
+        return [DulwichCommit(self, c) for c in results]
+
+    def commit_many(self, changesets, branch='master', parent=None):
+        """
+        Commits a sequence of `(changes, message, author, time)` entries in a
+        single pass, without going through the commit executor. The trees
+        stay in memory between the commits, all objects are written to one
+        pack and the branch is updated once. `time` may be None for now.
+        """
+        return self.do_commit_group([
+            (changes, {'message': message, 'author': author, 'commit_time': commit_time})
+            for changes, message, author, commit_time in changesets
+        ], branch=branch, parent=parent, pack=True)
+
+    def _close_tree(self, stack, writer):
+        bits, tree = stack.pop()
+        writer.add(tree)
+        stack[-1][1][bits[-1]] = (self.directory_mode, tree.id)
 
-        repo.refs['refs/heads/%s' % branch] = c.id
+    def _build_tree(self, entries, writer):
+        # with sorted paths every directory is complete once the next path
+        # leaves it, so each tree is written exactly once
+        entries.sort(key=itemgetter(0))
+        stack = [([], Tree())]
+        for bits, blob_id in entries:
+            dirs, filename = bits[:-1], bits[-1]
+            while stack[-1][0] != dirs[:len(stack[-1][0])]:
+                self._close_tree(stack, writer)
+            for name in dirs[len(stack[-1][0]):]:
+                stack.append((stack[-1][0] + [name], Tree()))
+            stack[-1][1][filename] = (self.file_mode, blob_id)
+        while len(stack) > 1:
+            self._close_tree(stack, writer)
+        root = stack[0][1]
+        writer.add(root)
+        return root
+
+    def import_files(self, files, message='', author=None, committer=None, branch='master', progress=None):
+        """
+        Commits the `(path, data)` pairs from `files` as the complete content
+        of `branch` in a single commit. Blobs are streamed into one pack as
+        they arrive, so only paths and shas are kept in memory. `progress` is
+        called with the number of files imported so far.
+        """
+        try:
+            parent = self._get_commit(None, branch)
+        except BranchDoesNotExist:
+            parent = None
+
+        writer = PackWriter(self.repo.object_store)
+        try:
+            entries = []
+            for path, data in files:
+                if isinstance(data, unicode):
+                    data = data.encode(self.default_encoding)
+                blob = Blob.from_string(data)
+                writer.add(blob)
+                entries.append((clean_path(path).split(os.path.sep), blob.id))
+                if progress and not len(entries) % 1000:
+                    progress(len(entries))
+            root = self._build_tree(entries, writer)
+            c = self._make_commit(root.id, parent and [parent.id] or [], message=message, author=author, committer=committer)
+            writer.add(c)
+        except:
+            writer.abort()
+            raise
+        writer.commit()
+        if progress:
+            progress(len(entries))
 
+        if not self._update_ref(branch, parent and parent.id, c.id):
+            raise CommitConflict(self, "branch '%s' changed during the import" % branch)
+        if not c.parents or c.parents[0] in self.commit_graph:
+            self.update_indexes([c.id])
         return DulwichCommit(self, c)
@@ -0,0 +1,91 @@
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from dulwich.objects import Blob
+
+
+class LRUCache(object):
+    def __init__(self, max_size, sizeof=None):
+        self.max_size = max_size
+        self.sizeof = sizeof or (lambda value: 1)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._data[key] = (value, size)
+            return value
+
+    def __setitem__(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_size:
+            return
+        with self._lock:
+            if key in self._data:
+                self.size -= self._data.pop(key)[1]
+            self._data[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                self.size -= self._data.popitem(last=False)[1][1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._data),
+            'size': self.size,
+        }
+
+
+# (tree sha, path) -> (mode, sha); trees are immutable, so entries never go stale
+tree_entry_cache = LRUCache(getattr(settings, 'VACUOUS_TREE_ENTRY_CACHE_SIZE', 10000))
+
+# (repo, sha) -> parsed object, bounded by the raw size of the cached objects
+object_cache = LRUCache(
+    getattr(settings, 'VACUOUS_OBJECT_CACHE_SIZE', 32 * 1024 * 1024),
+    sizeof=lambda obj: len(obj.as_raw_string()),
+)
+
+
+class CachedObjectStore(object):
+    """
+    Read-only, cached access to the objects of a repository. Objects handed
+    out are shared between threads and must not be modified.
+    """
+    max_blob_size = getattr(settings, 'VACUOUS_OBJECT_CACHE_MAX_BLOB_SIZE', 64 * 1024)
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.key = repo.controldir()
+
+    def __getitem__(self, sha):
+        key = (self.key, sha)
+        obj = object_cache.get(key)
+        if obj is None:
+            obj = self.repo[sha]
+            # refs resolve to objects too, but only shas are cacheable
+            if obj.id == sha and not (isinstance(obj, Blob) and len(obj.as_raw_string()) > self.max_blob_size):
+                object_cache[key] = obj
+        return obj
+
+    def __contains__(self, sha):
+        return sha in self.repo.object_store
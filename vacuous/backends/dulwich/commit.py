@@ -1,3 +1,5 @@
+import time
+import calendar
 import datetime
 
 from vacuous.backends.base import BaseCommit
@@ -22,6 +24,12 @@ def make_datetime(timestamp, tz):
     return datetime.datetime.fromtimestamp(timestamp, TZ(tz))
 
 
+def make_timestamp(dt):
+    if dt.utcoffset() is None:
+        return int(time.mktime(dt.timetuple()))
+    return calendar.timegm(dt.utctimetuple())
+
+
 class DulwichCommit(BaseCommit):
     def __init__(self, backend, commit):
         self._commit = commit
@@ -55,8 +63,8 @@ class DulwichCommit(BaseCommit):
     @property
     def paths(self):
         if not hasattr(self, '_paths'):
-            repo = self.backend.repo
-            commit = repo[self.revision]
-            parent_tree = repo[commit.parents[0]].tree if commit.parents else None
-            self._paths = list(tree_diff(repo, commit.tree, parent_tree))
+            objects = self.backend.objects
+            commit = self._commit
+            parent_tree = objects[commit.parents[0]].tree if commit.parents else None
+            self._paths = list(tree_diff(objects, commit.tree, parent_tree))
         return self._paths
@@ -0,0 +1,209 @@
+import os
+import re
+import heapq
+import hashlib
+import struct
+import threading
+from binascii import hexlify, unhexlify
+
+from vacuous.backends.dulwich.index import AppendOnlyLog, changed_paths
+
+
+_graphs = {}
+_graphs_lock = threading.Lock()
+
+_sha_re = re.compile(r'^[0-9a-f]{40}$')
+
+
+def get_commit_graph(repo):
+    path = os.path.join(repo.controldir(), CommitGraph.filename)
+    with _graphs_lock:
+        if path not in _graphs:
+            _graphs[path] = CommitGraph(path)
+        return _graphs[path]
+
+
+class BloomFilter(object):
+    bits_per_entry = 10
+    num_hashes = 7
+    # like git, commits touching too many paths get no filter at all
+    max_entries = 512
+
+    def __init__(self, data):
+        self.data = data
+        self.size = len(data) * 8
+
+    @classmethod
+    def from_paths(cls, paths):
+        if len(paths) > cls.max_entries:
+            return None
+        size = max(64, len(paths) * cls.bits_per_entry)
+        bits = bytearray((size + 7) // 8)
+        bloom = cls(bits)
+        for path in paths:
+            for bit in bloom._bits(path):
+                bits[bit // 8] |= 1 << (bit % 8)
+        bloom.data = str(bits)
+        return bloom
+
+    def _bits(self, path):
+        h1, h2 = struct.unpack('>II', hashlib.md5(path).digest()[:8])
+        for i in xrange(self.num_hashes):
+            yield (h1 + i * h2) % self.size
+
+    def __contains__(self, path):
+        data = self.data
+        for bit in self._bits(path):
+            if not ord(data[bit // 8]) & (1 << (bit % 8)):
+                return False
+        return True
+
+
+class CommitGraph(AppendOnlyLog):
+    """
+    The commit graph. For each commit it records the generation number (one
+    more than the largest generation of its parents), the commit time, the
+    parents and a bloom filter over the changed paths, so ancestry and "did
+    this commit touch X" questions can be answered without reading commit
+    objects.
+    """
+    filename = 'vacuous-commit-graph'
+
+    def clear(self):
+        self.commits = {}
+
+    def __contains__(self, commit_id):
+        return commit_id in self.commits
+
+    def _load(self, record):
+        fields = record.split(' ')
+        if len(fields) != 5:
+            raise ValueError("expected 5 fields, got %s" % len(fields))
+        commit_id, generation, commit_time, parents, bloom = fields
+        parents = parents != '-' and parents.split(',') or []
+        # parents are always recorded first, a commit whose parents are
+        # missing would break every walk through it
+        for sha in [commit_id] + parents:
+            if not _sha_re.match(sha):
+                raise ValueError("invalid commit id %r" % sha)
+        for parent in parents:
+            if parent not in self.commits:
+                raise ValueError("unknown parent %s" % parent)
+        generation, commit_time = int(generation), int(commit_time)
+        if generation != 1 + max([self.commits[parent][0] for parent in parents] or [0]):
+            raise ValueError("invalid generation %s" % generation)
+        try:
+            bloom = bloom != '*' and BloomFilter(unhexlify(bloom)) or None
+        except TypeError:
+            raise ValueError("invalid bloom filter")
+        self.commits[commit_id] = (generation, commit_time, parents, bloom)
+
+    def update(self, repo, heads, changes=None):
+        with self._lock:
+            self.refresh()
+            if self.damaged:
+                self.reset()
+            lines = []
+            generations = {}
+            parsed = {}
+            pending = list(heads)
+            while pending:
+                commit_id = pending[-1]
+                if commit_id in self.commits or commit_id in generations:
+                    pending.pop()
+                    continue
+                if commit_id not in parsed:
+                    parsed[commit_id] = repo[commit_id]
+                commit = parsed[commit_id]
+                # parents have to be numbered first
+                missing = [parent for parent in commit.parents if parent not in self.commits and parent not in generations]
+                if missing:
+                    pending.extend(missing)
+                    continue
+                pending.pop()
+                del parsed[commit_id]
+                generation = 1 + max([generations.get(parent) or self.commits[parent][0] for parent in commit.parents] or [0])
+                generations[commit_id] = generation
+                bloom = BloomFilter.from_paths(changed_paths(repo, commit, changes))
+                lines.append('%s %s %s %s %s' % (
+                    commit_id,
+                    generation,
+                    commit.commit_time,
+                    ','.join(commit.parents) or '-',
+                    bloom and hexlify(bloom.data) or '*',
+                ))
+            if lines:
+                self.append(lines)
+
+    def generation(self, commit_id):
+        return self.commits[commit_id][0]
+
+    def commit_time(self, commit_id):
+        return self.commits[commit_id][1]
+
+    def parents(self, commit_id):
+        return self.commits[commit_id][2]
+
+    def maybe_touches(self, commit_id, path):
+        bloom = self.commits[commit_id][3]
+        return bloom is None or path in bloom
+
+    def walk(self, heads, since_revision=None, since_time=None, min_generation=0):
+        commits = self.commits
+        heap = []
+        visited = set()
+
+        def push(commit_id):
+            if commit_id not in visited and commits[commit_id][0] >= min_generation:
+                visited.add(commit_id)
+                heapq.heappush(heap, (-commits[commit_id][1], commit_id))
+
+        for commit_id in heads:
+            push(commit_id)
+        while heap:
+            commit_time, commit_id = heapq.heappop(heap)
+            # the heap is ordered by date, so everything left is older
+            if since_time is not None and since_time > -commit_time:
+                break
+            yield commit_id
+            if commit_id != since_revision:
+                for parent in commits[commit_id][2]:
+                    push(parent)
+
+    def is_ancestor(self, ancestor, commit_id):
+        commits = self.commits
+        generation = commits[ancestor][0]
+        pending = [commit_id]
+        visited = set()
+        while pending:
+            commit_id = pending.pop()
+            if commit_id == ancestor:
+                return True
+            for parent in commits[commit_id][2]:
+                # a commit can only reach commits with smaller generations
+                if parent not in visited and commits[parent][0] >= generation:
+                    visited.add(parent)
+                    pending.append(parent)
+        return False
+
+    def merge_base(self, a, b):
+        if a == b:
+            return a
+        commits = self.commits
+        flags = {a: 1, b: 2}
+        heap = [(-commits[a][0], a), (-commits[b][0], b)]
+        heapq.heapify(heap)
+        while heap:
+            # all children of a commit have larger generations, so its
+            # flags are final by the time it is popped
+            generation, commit_id = heapq.heappop(heap)
+            flag = flags[commit_id]
+            if flag == 3:
+                return commit_id
+            for parent in commits[commit_id][2]:
+                if parent not in flags:
+                    flags[parent] = flag
+                    heapq.heappush(heap, (-commits[parent][0], parent))
+                else:
+                    flags[parent] |= flag
+        return None
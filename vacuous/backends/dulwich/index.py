@@ -0,0 +1,217 @@
+import os
+import re
+import zlib
+import uuid
+import fcntl
+import threading
+
+from vacuous.backends.dulwich.utils import tree_diff, iter_blob_paths
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+_sha_re = re.compile(r'^[0-9a-f]{40}$')
+
+
+def get_path_index(repo):
+    path = os.path.join(repo.controldir(), PathIndex.filename)
+    with _indexes_lock:
+        if path not in _indexes:
+            _indexes[path] = PathIndex(path)
+        return _indexes[path]
+
+
+def iter_prefixes(path):
+    yield path
+    while True:
+        path = os.path.dirname(path)
+        if not path:
+            break
+        yield path
+
+
+def changed_paths(repo, commit, cache=None):
+    if cache is not None and commit.id in cache:
+        return cache[commit.id]
+    paths = set()
+    if commit.parents:
+        for parent in commit.parents:
+            paths.update(tree_diff(repo, commit.tree, repo[parent].tree))
+    else:
+        paths.update(iter_blob_paths(repo, commit.tree))
+    result = set()
+    for path in paths:
+        result.update(iter_prefixes(path))
+    if cache is not None:
+        cache[commit.id] = result
+    return result
+
+
+def _checksum(record):
+    return '%08x' % (zlib.crc32(record) & 0xffffffff)
+
+
+class AppendOnlyLog(object):
+    """
+    Base class for the sidecar files kept next to a repository. Records are
+    appended as lines that end with a checksum and are loaded incrementally.
+    The first line holds a random token, so a file that was deleted or
+    rebuilt is reloaded. Damaged records are skipped and set `damaged`, the
+    log is then rebuilt with `reset()`.
+    """
+    filename = None
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._token = None
+        self._offset = 0
+        self.damaged = False
+        self.clear()
+
+    def clear(self):
+        raise NotImplementedError
+
+    def _load(self, record):
+        """
+        Loads a single record. Raises ValueError, without changing any
+        state, if the record is malformed.
+        """
+        raise NotImplementedError
+
+    def refresh(self):
+        with self._lock:
+            try:
+                f = open(self.path, 'rb')
+            except IOError:
+                f = None
+            try:
+                token = f and f.readline() or None
+                if token is not None and not token.endswith('\n'):
+                    # the file is just being created
+                    return
+                if token != self._token:
+                    self._token = token
+                    self._offset = token and len(token) or 0
+                    self.damaged = False
+                    self.clear()
+                if not f:
+                    return
+                f.seek(self._offset)
+                data = f.read()
+            finally:
+                if f:
+                    f.close()
+            # ignore a trailing partial record, it will be picked up later
+            end = data.rfind('\n') + 1
+            for line in data[:end].split('\n')[:-1]:
+                record, _, checksum = line.rpartition(' ')
+                try:
+                    if checksum != _checksum(record):
+                        raise ValueError("bad checksum")
+                    self._load(record)
+                except ValueError:
+                    # torn by a crash or written in an older format
+                    self.damaged = True
+            self._offset += end
+
+    def append(self, records):
+        data = ''.join('%s %s\n' % (record, _checksum(record)) for record in records)
+        with self._lock:
+            fd = os.open(self.path, os.O_CREAT | os.O_RDWR | os.O_APPEND)
+            try:
+                # writers in other processes append to the same file
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                if not os.fstat(fd).st_size:
+                    data = '%s\n%s' % (uuid.uuid4().hex, data)
+                else:
+                    os.lseek(fd, -1, os.SEEK_END)
+                    if os.read(fd, 1) != '\n':
+                        # a crash cut the last record short, keep it apart
+                        data = '\n' + data
+                os.write(fd, data)
+            finally:
+                # closing releases the lock
+                os.close(fd)
+            self.refresh()
+
+    def reset(self):
+        """
+        Starts over with an empty log under a new token, every process
+        reloads it.
+        """
+        with self._lock:
+            tmp_path = '%s.%s.tmp' % (self.path, uuid.uuid4().hex)
+            f = open(tmp_path, 'wb')
+            try:
+                f.write('%s\n' % uuid.uuid4().hex)
+            finally:
+                f.close()
+            os.rename(tmp_path, self.path)
+            self.refresh()
+
+
+class PathIndex(AppendOnlyLog):
+    """
+    The paths changed by each commit. Each record holds a commit sha and the
+    changed paths (including all parent directories), escaped and separated
+    by NUL bytes.
+    """
+    filename = 'vacuous-path-index'
+
+    def clear(self):
+        self.commits = set()
+        self.paths = {}
+
+    def __contains__(self, commit_id):
+        return commit_id in self.commits
+
+    def _load(self, record):
+        commit_id, paths = record.split(' ', 1)
+        if not _sha_re.match(commit_id):
+            raise ValueError("invalid commit id %r" % commit_id)
+        paths = [path.decode('string_escape') for path in paths.split('\0') if path]
+        self.commits.add(commit_id)
+        for path in paths:
+            self.paths.setdefault(path, set()).add(commit_id)
+
+    def update(self, repo, heads, changes=None):
+        with self._lock:
+            self.refresh()
+            if self.damaged:
+                self.reset()
+            lines = []
+            seen = set()
+            pending = list(heads)
+            while pending:
+                commit_id = pending.pop()
+                if commit_id in self.commits or commit_id in seen:
+                    continue
+                seen.add(commit_id)
+                commit = repo[commit_id]
+                # paths may contain newlines
+                paths = [path.encode('string_escape') for path in sorted(changed_paths(repo, commit, changes))]
+                lines.append('%s %s' % (commit_id, '\0'.join(paths)))
+                pending.extend(commit.parents)
+            if lines:
+                self.append(lines)
+
+    def iter_history(self, graph, heads, path, since_revision=None, since_time=None):
+        """
+        Yields the ids of all commits reachable from `heads` that changed
+        `path`, newest first. `heads` must have been added to both this
+        index and the commit `graph`. Records are only ever added, so no
+        lock is held while iterating.
+        """
+        candidates = set(self.paths.get(path, ()))
+        if not candidates:
+            return
+        # commits with smaller generations cannot reach any candidate
+        min_generation = min(graph.generation(commit_id) for commit_id in candidates)
+        for commit_id in graph.walk(heads, since_revision=since_revision, since_time=since_time, min_generation=min_generation):
+            if not candidates:
+                break
+            if commit_id in candidates:
+                candidates.discard(commit_id)
+                yield commit_id
@@ -0,0 +1,209 @@
+import os
+import re
+import time
+
+from django.conf import settings
+
+from dulwich.objects import Commit, Tree, Tag
+from dulwich.file import GitFile
+
+from vacuous.backends.dulwich.pack import PackWriter
+
+
+LOOSE_OBJECT_LIMIT = getattr(settings, 'VACUOUS_MAINTENANCE_LOOSE_OBJECTS', 6700)
+PACK_LIMIT = getattr(settings, 'VACUOUS_MAINTENANCE_PACKS', 50)
+# unreferenced objects younger than this may belong to a commit in progress
+PRUNE_GRACE = getattr(settings, 'VACUOUS_MAINTENANCE_PRUNE_GRACE', 14 * 24 * 3600)
+
+S_IFGITLINK = 0160000
+
+_loose_dir_re = re.compile(r'^[0-9a-f]{2}$')
+_loose_name_re = re.compile(r'^[0-9a-f]{38}$')
+
+
+def estimate_loose_objects(repo):
+    # like `git gc --auto`, extrapolate from a single fan-out directory
+    try:
+        return 256 * len(os.listdir(os.path.join(repo.object_store.path, '17')))
+    except OSError:
+        return 0
+
+
+def iter_pack_names(repo):
+    for name in os.listdir(repo.object_store.pack_dir):
+        if name.startswith('pack-') and name.endswith('.pack'):
+            yield name[:-5]
+
+
+def iter_loose_objects(repo):
+    path = repo.object_store.path
+    for dirname in os.listdir(path):
+        if not _loose_dir_re.match(dirname):
+            continue
+        for filename in os.listdir(os.path.join(path, dirname)):
+            if _loose_name_re.match(filename):
+                yield dirname + filename, os.path.join(path, dirname, filename)
+
+
+def needs_maintenance(repo):
+    return estimate_loose_objects(repo) > LOOSE_OBJECT_LIMIT or len(list(iter_pack_names(repo))) > PACK_LIMIT
+
+
+def iter_reachable(object_store, heads):
+    """
+    Yields `(object, path)` for every object reachable from `heads`. Trees
+    and blobs come with the first path they were found at, commits and tags
+    with None.
+    """
+    seen = set()
+    pending = [(sha, None) for sha in heads]
+    while pending:
+        sha, path = pending.pop()
+        if sha in seen:
+            continue
+        seen.add(sha)
+        obj = object_store[sha]
+        yield obj, path
+        if isinstance(obj, Commit):
+            pending.append((obj.tree, ''))
+            pending.extend((parent, None) for parent in obj.parents)
+        elif isinstance(obj, Tree):
+            for mode, name, hexsha in obj.items():
+                # submodule commits live in another repository
+                if mode & 0170000 != S_IFGITLINK:
+                    pending.append((hexsha, os.path.join(path, name)))
+        elif isinstance(obj, Tag):
+            pending.append((obj.object[1], None))
+
+
+def repack(repo):
+    """
+    Writes every object reachable from a ref into a single new pack, then
+    removes loose objects that got packed and the packs that existed
+    before. Objects written concurrently are neither reachable from the
+    ref snapshot nor old enough to be pruned, so writers never need to be
+    locked out.
+    """
+    object_store = repo.object_store
+    old_packs = set(iter_pack_names(repo))
+    heads = set(sha for name, sha in repo.get_refs().iteritems() if name != 'HEAD')
+
+    writer = PackWriter(object_store, deltas=True)
+    try:
+        for obj, path in iter_reachable(object_store, heads):
+            writer.add(obj, path)
+    except:
+        writer.abort()
+        raise
+    packed = writer.written
+    writer.commit()
+
+    deadline = time.time() - PRUNE_GRACE
+    for sha, path in iter_loose_objects(repo):
+        try:
+            if sha in packed or os.stat(path).st_mtime < deadline:
+                os.remove(path)
+        except OSError:
+            pass
+
+    for name in old_packs:
+        basename = os.path.join(object_store.pack_dir, name)
+        try:
+            # a pack pushed concurrently may not be referenced yet; this also
+            # keeps the new pack if it replaced one with the same name
+            if os.stat(basename + '.pack').st_mtime >= deadline:
+                continue
+            os.remove(basename + '.idx')
+            os.remove(basename + '.pack')
+        except OSError:
+            pass
+
+
+def pack_refs(repo):
+    """
+    Moves loose refs into packed-refs. packed-refs is locked for the whole
+    read-modify-write and so is every loose ref until it is removed, so
+    concurrent ref updates and deletions are never lost or undone. Refs
+    that are locked by somebody else stay loose.
+    """
+    refs = repo.refs
+    controldir = repo.controldir()
+    # GitFile locks through packed-refs.lock and renames on close
+    try:
+        f = GitFile(os.path.join(controldir, 'packed-refs'), 'wb')
+    except OSError:
+        # somebody else is rewriting packed-refs
+        return
+    locks = []
+    try:
+        loose = {}
+        for name in refs.allkeys():
+            if name == 'HEAD' or not name.startswith('refs/'):
+                continue
+            lock_path = os.path.join(controldir, name) + '.lock'
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError:
+                # somebody is updating the ref right now
+                continue
+            os.close(fd)
+            locks.append(lock_path)
+            sha = refs.read_loose_ref(name)
+            if sha and not sha.startswith('ref: '):
+                loose[name] = sha
+        if not loose:
+            return
+
+        # read packed-refs again now that nobody else can change it
+        refs._packed_refs = None
+        packed = dict(refs.get_packed_refs())
+        packed.update(loose)
+        lines = ['# pack-refs with: peeled\n']
+        for name in sorted(packed):
+            lines.append('%s %s\n' % (packed[name], name))
+            peeled = repo.get_peeled(name)
+            if peeled and peeled != packed[name]:
+                lines.append('^%s\n' % peeled)
+        f.write(''.join(lines))
+        f.close()
+
+        for name in loose:
+            os.remove(os.path.join(controldir, name))
+    finally:
+        f.abort()
+        for lock_path in locks:
+            os.remove(lock_path)
+        refs._packed_refs = None
+
+
+def _prune_dir(path, max_age, prefix=''):
+    deadline = time.time() - max_age
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return
+    for name in names:
+        if not name.startswith(prefix):
+            continue
+        try:
+            if os.stat(os.path.join(path, name)).st_mtime < deadline:
+                os.remove(os.path.join(path, name))
+        except OSError:
+            pass
+
+
+def prune_spool(repo, max_age=24 * 3600):
+    # spooled pushes are removed by their task, leftovers are from crashes
+    _prune_dir(os.path.join(repo.controldir(), 'vacuous-spool'), max_age)
+
+
+def prune_pack_cache(repo, max_age=24 * 3600):
+    # unfinished cache entries of aborted clones
+    _prune_dir(os.path.join(repo.controldir(), 'vacuous-pack-cache'), max_age, prefix='tmp-')
+
+
+def maintain(repo):
+    repack(repo)
+    pack_refs(repo)
+    prune_spool(repo)
+    prune_pack_cache(repo)
@@ -0,0 +1,178 @@
+import os
+import re
+import zlib
+import difflib
+import struct
+import hashlib
+import tempfile
+
+from django.conf import settings
+
+from dulwich.objects import Blob, Tree
+from dulwich.pack import OFS_DELTA
+
+from vacuous.backends.dulwich.cache import LRUCache
+
+# delta chains are capped like git's --depth, creating deltas is quadratic
+# in the size of the objects
+DELTA_DEPTH = getattr(settings, 'VACUOUS_PACK_DELTA_DEPTH', 50)
+DELTA_MAX_SIZE = getattr(settings, 'VACUOUS_PACK_DELTA_MAX_SIZE', 512 * 1024)
+# memory kept for delta bases
+DELTA_CACHE_SIZE = getattr(settings, 'VACUOUS_PACK_DELTA_CACHE_SIZE', 32 * 1024 * 1024)
+
+
+def pack_object_header(type_num, size):
+    c = (type_num << 4) | (size & 0x0f)
+    size >>= 4
+    header = []
+    while size:
+        header.append(chr(c | 0x80))
+        c = size & 0x7f
+        size >>= 7
+    header.append(chr(c))
+    return ''.join(header)
+
+
+_chunk_re = re.compile(r'[^\n\0]*[\n\0]|[^\n\0]+$')
+
+
+def encode_delta_size(size):
+    data = []
+    c = size & 0x7f
+    size >>= 7
+    while size:
+        data.append(chr(c | 0x80))
+        c = size & 0x7f
+        size >>= 7
+    data.append(chr(c))
+    return ''.join(data)
+
+
+def encode_copy(start, length):
+    op, args = 0x80, []
+    for i in range(4):
+        if start & (0xff << i * 8):
+            op |= 1 << i
+            args.append(chr((start >> i * 8) & 0xff))
+    for i in range(2):
+        if length & (0xff << i * 8):
+            op |= 1 << (4 + i)
+            args.append(chr((length >> i * 8) & 0xff))
+    return chr(op) + ''.join(args)
+
+
+def create_delta(base, target):
+    """
+    Returns a git delta that turns `base` into `target`. Both are matched
+    by lines (and tree entries), which finds the copies in text that a
+    byte-wise matcher drowns in junk heuristics.
+    """
+    a, b = _chunk_re.findall(base), _chunk_re.findall(target)
+    a_offsets = [0]
+    for chunk in a:
+        a_offsets.append(a_offsets[-1] + len(chunk))
+    b_offsets = [0]
+    for chunk in b:
+        b_offsets.append(b_offsets[-1] + len(chunk))
+    ops = [encode_delta_size(len(base)), encode_delta_size(len(target))]
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, a, b, autojunk=False).get_opcodes():
+        if tag == 'equal':
+            start, end = a_offsets[i1], a_offsets[i2]
+            while start < end:
+                length = min(end - start, 0xffff)
+                ops.append(encode_copy(start, length))
+                start += length
+        elif tag in ('replace', 'insert'):
+            start, end = b_offsets[j1], b_offsets[j2]
+            while start < end:
+                length = min(end - start, 0x7f)
+                ops.append(chr(length) + target[start:start + length])
+                start += length
+    return ''.join(ops)
+
+
+def encode_offset(offset):
+    data = [chr(offset & 0x7f)]
+    offset >>= 7
+    while offset:
+        offset -= 1
+        data.append(chr(0x80 | (offset & 0x7f)))
+        offset >>= 7
+    return ''.join(reversed(data))
+
+
+class PackWriter(object):
+    """
+    Streams objects into a single pack in the repository's pack directory.
+    The object count in the header is fixed up when the pack is committed,
+    so the number of objects does not have to be known in advance.
+
+    With `deltas`, trees and blobs added with a `path` are stored as deltas
+    against the previous object added for the same path, if that is
+    smaller.
+    """
+    def __init__(self, object_store, deltas=False):
+        self.object_store = object_store
+        fd, self.path = tempfile.mkstemp(dir=object_store.pack_dir, prefix='tmp-', suffix='.pack')
+        self.f = os.fdopen(fd, 'w+b')
+        self.f.write(struct.pack('>4sLL', 'PACK', 2, 0))
+        self.written = set()
+        # (type, path) -> (offset, data, depth)
+        self.bases = None
+        if deltas:
+            self.bases = LRUCache(DELTA_CACHE_SIZE, sizeof=lambda base: len(base[1]))
+
+    def __len__(self):
+        return len(self.written)
+
+    def add(self, obj, path=None):
+        if obj.id in self.written:
+            return
+        self.written.add(obj.id)
+        data = obj.as_raw_string()
+        if self.bases is None or path is None or not isinstance(obj, (Blob, Tree)) or len(data) > DELTA_MAX_SIZE:
+            self._write(obj.type_num, data)
+            return
+        key = (obj.type_num, path)
+        base = self.bases.get(key)
+        offset = self.f.tell()
+        depth = 0
+        delta = None
+        if base and base[2] < DELTA_DEPTH:
+            delta = create_delta(base[1], data)
+            if len(delta) > len(data) // 2:
+                delta = None
+        if delta:
+            depth = base[2] + 1
+            self._write(OFS_DELTA, delta, encode_offset(offset - base[0]))
+        else:
+            self._write(obj.type_num, data)
+        self.bases[key] = (offset, data, depth)
+
+    def _write(self, type_num, data, prefix=''):
+        self.f.write(pack_object_header(type_num, len(data)))
+        self.f.write(prefix)
+        self.f.write(zlib.compress(data))
+
+    def commit(self):
+        if not self.written:
+            self.abort()
+            return None
+        f = self.f
+        f.seek(8)
+        f.write(struct.pack('>L', len(self.written)))
+        f.flush()
+        f.seek(0)
+        sha = hashlib.sha1()
+        for chunk in iter(lambda: f.read(64 * 1024), ''):
+            sha.update(chunk)
+        f.seek(0, 2)
+        f.write(sha.digest())
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        return self.object_store.move_in_pack(self.path)
+
+    def abort(self):
+        self.f.close()
+        os.remove(self.path)
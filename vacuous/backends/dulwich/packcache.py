@@ -0,0 +1,125 @@
+import os
+import errno
+import hashlib
+import tempfile
+
+from django.conf import settings
+
+from vacuous.backends.dulwich.utils import get_pack_cache_dir
+from vacuous.backends.dulwich.advertisement import get_refs_version
+
+# upload-pack responses of clones are kept on disk up to this many bytes per repo
+PACK_CACHE_SIZE = getattr(settings, 'VACUOUS_PACK_CACHE_SIZE', 512 * 1024 * 1024)
+# larger upload-pack requests are never answered from the cache
+PACK_CACHE_MAX_REQUEST = getattr(settings, 'VACUOUS_PACK_CACHE_MAX_REQUEST', 256 * 1024)
+
+
+def iter_pkt_lines(data):
+    offset = 0
+    while offset + 4 <= len(data):
+        size = int(data[offset:offset + 4], 16)
+        if size < 4:
+            # flush-pkt
+            offset += 4
+            yield None
+            continue
+        yield data[offset + 4:offset + size]
+        offset += size
+
+
+def is_cacheable(request_body):
+    """
+    Only requests without haves (clones) are worth caching: their response
+    depends on nothing but the wants, the capabilities and the refs.
+    """
+    try:
+        return not any(line and line.startswith('have ') for line in iter_pkt_lines(request_body))
+    except ValueError:
+        return False
+
+
+def get_cache_key(backend, request_body):
+    if not PACK_CACHE_SIZE or len(request_body) > PACK_CACHE_MAX_REQUEST or not is_cacheable(request_body):
+        return None
+    version = get_refs_version(backend)
+    if not version:
+        return None
+    return '%s-%s' % (version, hashlib.sha1(request_body).hexdigest())
+
+
+def open_cached(backend, key):
+    path = os.path.join(get_pack_cache_dir(backend.repo), key)
+    try:
+        f = open(path, 'rb')
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    # the mtime orders entries for eviction
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+    return f
+
+
+def iter_cached(f, chunk_size=64 * 1024):
+    try:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            yield data
+    finally:
+        f.close()
+
+
+def iter_caching(backend, key, chunks):
+    """
+    Yields `chunks` and stores them under `key` once they are exhausted.
+    Nothing is stored if the response is aborted.
+    """
+    cache_dir = get_pack_cache_dir(backend.repo)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='tmp-')
+    f = os.fdopen(fd, 'wb')
+    try:
+        for chunk in chunks:
+            f.write(chunk)
+            yield chunk
+    except:
+        f.close()
+        os.remove(tmp_path)
+        raise
+    f.close()
+    os.rename(tmp_path, os.path.join(cache_dir, key))
+    evict(cache_dir, key.split('-', 1)[0])
+
+
+def evict(cache_dir, version):
+    """
+    Removes entries for outdated refs, then the least recently used ones
+    until the cache fits into `PACK_CACHE_SIZE`.
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.startswith('tmp-'):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            if not name.startswith(version + '-'):
+                os.remove(path)
+                continue
+            st = os.stat(path)
+        except OSError:
+            # evicted concurrently
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+    size = sum(entry[1] for entry in entries)
+    for mtime, entry_size, path in sorted(entries):
+        if size <= PACK_CACHE_SIZE:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        size -= entry_size
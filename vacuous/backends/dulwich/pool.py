@@ -0,0 +1,133 @@
+import os
+import thread
+import weakref
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from dulwich.repo import Repo
+
+
+def close_repo(repo):
+    close = getattr(repo.object_store, 'close', None)
+    if close:
+        close()
+
+
+class PooledRepo(object):
+    def __init__(self, path):
+        self.path = path
+        self.repo = Repo(path)
+        self.leases = 0
+        self.evicted = False
+        self.stamp = self.get_stamp()
+        self.fds = self.count_fds()
+
+    def _stat(self, name):
+        try:
+            st = os.stat(os.path.join(self.repo.controldir(), name))
+        except OSError:
+            return None
+        return st.st_ino, st.st_mtime
+
+    def _mtime(self, name):
+        st = self._stat(name)
+        return st and st[1]
+
+    def get_stamp(self):
+        # packed refs are cached by the refs container and the object store
+        # doesn't rescan the pack directory on its own; the inodes catch
+        # repositories that were deleted and created again
+        return self._stat(''), self._stat(os.path.join('objects', 'pack')), self._mtime('packed-refs')
+
+    def is_stale(self):
+        return self.get_stamp() != self.stamp
+
+    def count_fds(self):
+        # every open pack holds the pack data and its index
+        self.pack_mtime = self._mtime(os.path.join('objects', 'pack'))
+        try:
+            names = os.listdir(os.path.join(self.repo.controldir(), 'objects', 'pack'))
+        except OSError:
+            return 0
+        return 2 * len([name for name in names if name.endswith('.pack')])
+
+    def update_fds(self):
+        if self._mtime(os.path.join('objects', 'pack')) != self.pack_mtime:
+            self.fds = self.count_fds()
+
+    def close(self):
+        close_repo(self.repo)
+
+
+class RepoPool(object):
+    """
+    A process-wide pool of open repositories. dulwich reads packs through
+    shared file objects, so every thread gets handles of its own. Backends
+    lease a handle and release it when they are garbage collected; idle
+    handles are closed in LRU order once there are more than `max_repos`
+    of them or their packs use more than `max_fds` file descriptors.
+    """
+    def __init__(self, max_repos, max_fds):
+        self.max_repos = max_repos
+        self.max_fds = max_fds
+        self._entries = OrderedDict()
+        self._leases = {}
+        self._lock = threading.RLock()
+
+    def acquire(self, path, owner):
+        key = (os.path.abspath(path), thread.get_ident())
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry and entry.is_stale():
+                self._evict(entry)
+                entry = None
+            if entry is None:
+                entry = PooledRepo(key[0])
+            else:
+                entry.update_fds()
+            self._entries[key] = entry
+            entry.leases += 1
+            # weakrefs to the same owner compare equal, key them by identity
+            ref = weakref.ref(owner, self._release)
+            self._leases[id(ref)] = (ref, entry)
+            self._trim()
+            return entry.repo
+
+    def _release(self, ref):
+        with self._lock:
+            ref, entry = self._leases.pop(id(ref), (None, None))
+            if entry is None:
+                return
+            entry.leases -= 1
+            if entry.evicted and not entry.leases:
+                entry.close()
+
+    def _evict(self, entry):
+        entry.evicted = True
+        if not entry.leases:
+            entry.close()
+
+    def discard(self, path):
+        path = os.path.abspath(path)
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == path]:
+                self._evict(self._entries.pop(key))
+
+    def _trim(self):
+        fds = sum(entry.fds for entry in self._entries.itervalues())
+        for key, entry in self._entries.items():
+            if len(self._entries) <= self.max_repos and fds <= self.max_fds:
+                break
+            if entry.leases:
+                continue
+            del self._entries[key]
+            fds -= entry.fds
+            self._evict(entry)
+
+
+repo_pool = RepoPool(
+    getattr(settings, 'VACUOUS_REPO_POOL_SIZE', 100),
+    getattr(settings, 'VACUOUS_REPO_POOL_MAX_FDS', 512),
+)
@@ -1,3 +1,4 @@
+import os
 from StringIO import StringIO
 
 from celery.task import Task
@@ -9,6 +10,7 @@ from dulwich.server import ReceivePackHandler
 from vacuous.backends import load_backend
 from vacuous.backends.dulwich.utils import WebBackend
 from vacuous.tasks import SyncTask
+from vacuous.jobs import SyncJob
 
 
 class _ReceivePackHandler(ReceivePackHandler):
@@ -23,22 +25,35 @@ class _ReceivePackHandler(ReceivePackHandler):
 
 
 class ReceivePackTask(Task):
-    def run(self, flavor, repo_path, data):
+    def run(self, flavor, repo_path, spool_path):
         backend = load_backend(flavor, repo_path, cache=False)
         out = StringIO()
-        proto = ReceivableProtocol(StringIO(data).read, out.write)
-        handler = _ReceivePackHandler(WebBackend(), [backend], proto, stateless_rpc=True)
-        handler.handle()
+        # the request body was spooled to disk by the view, the pack is
+        # indexed straight from there
+        f = open(spool_path, 'rb')
+        try:
+            proto = ReceivableProtocol(f.read, out.write)
+            handler = _ReceivePackHandler(WebBackend(), [backend], proto, stateless_rpc=True)
+            handler.handle()
+        finally:
+            f.close()
+            os.remove(spool_path)
         
-        sync_tasks = []
+        branches = []
         for oldrev, newrev, name in handler._good_refs:
             if name.startswith('refs/heads/'):
-                branch = name[11:]
-                sync_tasks.append(subtask(SyncTask, args=[backend.flavor, backend.path, oldrev, newrev, branch]))
-                
-        if sync_tasks:
-            taskset = TaskSet(tasks=sync_tasks)
-            taskset.apply_async().join()
+                branches.append((oldrev, newrev, name[11:]))
+
+        # the refs are updated, the sync runs in the background and catches
+        # up the path index and commit graph on the way (see sync_plan)
+        job = None
+        if branches:
+            job = SyncJob.create(len(branches), repo=backend.path, refs=handler._good_refs)
+            taskset = TaskSet(tasks=[
+                subtask(SyncTask, args=[backend.flavor, backend.path, oldrev, newrev, branch], kwargs={'job_id': job.id})
+                for oldrev, newrev, branch in branches
+            ])
+            taskset.apply_async()
         
-        return out.getvalue(), handler._good_refs
+        return out.getvalue(), handler._good_refs, job and job.id
         
@@ -1,6 +1,10 @@
 import os
 import stat
 
+from dulwich.objects import Tree
+
+from vacuous.backends.dulwich.cache import tree_entry_cache
+
 
 def clean_path(path):
     try:
@@ -32,6 +36,8 @@ def tree_diff(repo, a, b):
             a_isdir = stat.S_ISDIR(a_mode)
             if b and name in b:
                 b_mode, b_hexsha = b[name]
+                if a_mode == b_mode and a_hexsha == b_hexsha:
+                    continue
                 b_isdir = stat.S_ISDIR(b_mode)
                 if not a_isdir or not b_isdir:
                     yield name
@@ -55,32 +61,49 @@ def tree_diff(repo, a, b):
                     yield name
 
 
-def get_by_path(repo, tree, path):
-    for bit in path.split(os.path.sep):
-        found = False
-        for mode, name, hexsha in tree.items():
-            if name == bit:
-                tree = repo[hexsha]
-                found = True
+def copy_tree(tree):
+    copy = Tree()
+    for mode, name, hexsha in tree.items():
+        copy[name] = (mode, hexsha)
+    return copy
+
+
+def lookup_path(repo, tree_id, path):
+    key = (tree_id, path)
+    entry = tree_entry_cache.get(key)
+    if entry is None:
+        mode, hexsha = None, tree_id
+        for bit in path.split(os.path.sep):
+            tree = repo[hexsha]
+            if not isinstance(tree, Tree) or bit not in tree:
+                mode, hexsha = None, None
                 break
-        if not found:
-            return None
-    return tree
-
-
-def is_same_object(repo, a, b, path):
-    for bit in path.split(os.path.sep):
-        in_a = bit in a
-        in_b = bit in b
-        if not in_a or not in_b:
-            return in_a == in_b
-        a_mode, a_sha = a[bit]
-        b_mode, b_sha = b[bit]
-        if a_mode != b_mode:
-            return False
-        a = repo[a_sha]
-        b = repo[b_sha]
-    return a == b
+            mode, hexsha = tree[bit]
+        entry = (mode, hexsha)
+        tree_entry_cache[key] = entry
+    if entry[1] is None:
+        return None
+    return entry
+
+
+def get_spool_dir(repo):
+    return _get_control_dir(repo, 'vacuous-spool')
+
+
+def get_pack_cache_dir(repo):
+    return _get_control_dir(repo, 'vacuous-pack-cache')
+
+
+def _get_control_dir(repo, name):
+    path = os.path.join(repo.controldir(), name)
+    if not os.path.isdir(path):
+        try:
+            os.mkdir(path)
+        except OSError:
+            # created concurrently
+            if not os.path.isdir(path):
+                raise
+    return path
 
 
 class WebBackend(object):
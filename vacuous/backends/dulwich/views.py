@@ -1,29 +1,51 @@
 import re
 import os
+import sys
+import zlib
+import hashlib
+import Queue
+import tempfile
+import threading
+import itertools
 from base64 import b64decode
-from StringIO import StringIO
-from gzip import GzipFile
 from functools import wraps
 
 from django.http import HttpResponse, HttpResponseNotFound, HttpResponseForbidden, HttpResponseServerError, HttpResponseRedirect, Http404
 from django.views.decorators.cache import never_cache
-from django.views.decorators.http import require_http_methods
+from django.views.decorators.http import require_http_methods, condition
+from django.utils.cache import patch_cache_control
 from django.core.urlresolvers import reverse
 from django.conf.urls.defaults import url, patterns
 from django.conf import settings
+from django.utils import simplejson
 
 from dulwich.web import HTTPGitRequest, get_text_file, get_info_refs, get_info_packs, get_loose_object, get_pack_file, get_idx_file
 from dulwich.protocol import ReceivableProtocol
 from dulwich.server import DEFAULT_HANDLERS, UploadPackHandler
 
-from vacuous.backends.dulwich.utils import WebBackend
+from vacuous.backends import load_backend
+from vacuous.backends.dulwich.utils import WebBackend, get_spool_dir
+from vacuous.backends.dulwich.advertisement import get_advertisement
+from vacuous.backends.dulwich import packcache
 from vacuous.backends.dulwich.tasks import ReceivePackTask
+from vacuous.jobs import SyncJob
 from vacuous.signals import post_push
 
 
 _http_basic_auth_re = re.compile(r'^basic ([a-z0-9+/=]+)$', re.IGNORECASE)
 
 class GitServer(object):
+    # 'x-sendfile' or 'x-accel-redirect' hands pack, index and text files
+    # off to the front-end server
+    sendfile = getattr(settings, 'VACUOUS_GIT_SENDFILE', None)
+    # for X-Accel-Redirect: an internal location that maps to `sendfile_root`
+    sendfile_root = getattr(settings, 'VACUOUS_GIT_SENDFILE_ROOT', '/')
+    sendfile_url = getattr(settings, 'VACUOUS_GIT_SENDFILE_URL', '/')
+    # objects and packs never change, allow shared caches to keep them with
+    # `cache_public`
+    cache_max_age = getattr(settings, 'VACUOUS_GIT_CACHE_MAX_AGE', 365 * 24 * 3600)
+    cache_public = getattr(settings, 'VACUOUS_GIT_CACHE_PUBLIC', False)
+
     def authenticate(self, request, username, password, **kwargs):
         return settings.DEBUG
     
@@ -37,6 +59,7 @@ class GitServer(object):
         @wraps(view)
         def wrapped(request, **kwargs):
             kwargs['backend'] = self.get_backend_or_404(request, **kwargs)
+            kwargs['server'] = self
             response = None
             match = _http_basic_auth_re.match(request.META.get('HTTP_AUTHORIZATION', ''))
             if match:
@@ -53,6 +76,9 @@ class GitServer(object):
             return response
         return wrapped
     
+    def get_sendfile_url(self, path):
+        return self.sendfile_url.rstrip('/') + '/' + os.path.relpath(path, self.sendfile_root)
+
     def get_url(self, **kwargs):
         return reverse(self.info, kwargs=kwargs)[:-1]
     
@@ -72,6 +98,7 @@ class GitServer(object):
             url(r'^(?P<path>objects/pack/pack-[0-9a-f]{40}\.idx)$', self.wrap(objects_pack_idx)),
             url(r'^git-upload-pack$', self.wrap(git_upload_pack)),
             url(r'^git-receive-pack$', self.wrap(git_receive_pack)),
+            url(r'^sync/(?P<job_id>[0-9a-f]{32})$', self.wrap(sync_status)),
         )
 
 
@@ -84,7 +111,7 @@ def require_ssl(view):
     return with_ssl
 
 
-def gitview(method, cache=None, ssl=None, push=False):
+def gitview(method, cache=None, ssl=None, push=False, etag=None):
     def decorator(func):
         @require_http_methods([method])
         @wraps(func)
@@ -94,8 +121,12 @@ def gitview(method, cache=None, ssl=None, push=False):
             except Exception as e:
                 print e
                 raise
+        if etag:
+            decorated = condition(etag_func=etag)(decorated)
         if cache is False:
             decorated = never_cache(decorated)
+        if cache or etag:
+            decorated = cache_control(decorated, cache)
         if ssl:
             decorated = require_ssl(decorated)
         decorated.push = push
@@ -103,13 +134,129 @@ def gitview(method, cache=None, ssl=None, push=False):
     return decorator
 
 
+def cache_control(view, cache):
+    @wraps(view)
+    def decorated(request, *args, **kwargs):
+        response = view(request, *args, **kwargs)
+        server = kwargs.get('server')
+        if not server or response.status_code not in (200, 206, 304):
+            return response
+        directives = {}
+        if server.cache_public:
+            directives['public'] = True
+        else:
+            directives['private'] = True
+        if cache:
+            directives.update(max_age=server.cache_max_age, immutable=True)
+        patch_cache_control(response, **directives)
+        return response
+    return decorated
+
+
+def file_checksum(path):
+    # packs and pack indexes end with the sha1 of their content
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        f.seek(-20, 2)
+        return f.read(20).encode('hex')
+    except IOError:
+        return None
+    finally:
+        f.close()
+
+
+def file_etag(request, backend=None, path=None, **kwargs):
+    return file_checksum(os.path.join(backend.repo.controldir(), path))
+
+
+def object_etag(request, hexsha_hi=None, hexsha_lo=None, **kwargs):
+    return "%s%s" % (hexsha_hi, hexsha_lo)
+
+
+def refs_etag(request, backend=None, **kwargs):
+    service = request.GET.get('service', None)
+    if service and service not in DEFAULT_HANDLERS:
+        return None
+    return get_advertisement(backend, service)[0]
+
+
+def packs_etag(request, backend=None, **kwargs):
+    names = sorted(pack.name() for pack in backend.repo.object_store.packs)
+    return hashlib.sha1('\n'.join(names)).hexdigest()
+
+
+_range_re = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+def parse_range(header, size):
+    """
+    Returns `(start, end)` for a single byte range, `None` if the whole
+    file should be sent and `False` if the range can't be satisfied.
+    """
+    match = _range_re.match(header.strip()) if header else None
+    if not match or not any(match.groups()):
+        # no or multiple ranges, fall back to the whole file
+        return None
+    start, end = match.groups()
+    if not start:
+        start, end = max(0, size - int(end)), size - 1
+    else:
+        start, end = int(start), min(int(end) if end else size - 1, size - 1)
+    if start > end:
+        return False
+    return start, end
+
+
+def iter_file(f, length, chunk_size=64 * 1024):
+    try:
+        while length > 0:
+            data = f.read(min(chunk_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+def serve_file(request, server, path, content_type):
+    if not os.path.isfile(path):
+        raise Http404
+    if server.sendfile == 'x-sendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = path
+        return response
+    if server.sendfile == 'x-accel-redirect':
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = server.get_sendfile_url(path)
+        return response
+
+    f = open(path, 'rb')
+    size = os.fstat(f.fileno()).st_size
+    byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+    if byte_range is False:
+        f.close()
+        response = HttpResponse(content_type=content_type, status=416)
+        response['Content-Range'] = 'bytes */%s' % size
+        return response
+    start, end = byte_range or (0, size - 1)
+    f.seek(start)
+    response = HttpResponse(iter_file(f, end - start + 1), content_type=content_type, status=byte_range and 206 or 200)
+    if byte_range:
+        response['Content-Range'] = 'bytes %s-%s/%s' % (start, end, size)
+    response['Content-Length'] = str(end - start + 1)
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
 @gitview('GET', cache=False)
-def serve_text_file(request, backend=None, path=None, **kwargs):
-    repo = backend.repo
-    return HttpResponse(repo.get_named_file(path), content_type='text/plain')
+def serve_text_file(request, backend=None, path=None, server=None, **kwargs):
+    return serve_file(request, server, os.path.join(backend.repo.controldir(), path), 'text/plain')
 
 
-@gitview('GET', cache=True)
+@gitview('GET', cache=True, etag=object_etag)
 def loose_object(request, backend=None, hexsha_hi=None, hexsha_lo=None, **kwargs):
     repo = backend.repo
     hexsha = "%s%s" % (hexsha_hi, hexsha_lo)
@@ -121,54 +268,35 @@ def loose_object(request, backend=None, hexsha_hi=None, hexsha_lo=None, **kwargs
         return HttpResponseServerError('Error reading object')
 
 
-@gitview('GET', cache=True)
-def objects_pack_pack(request, backend=None, path=None, **kwargs):
-    return HttpResponse(backend.repo.get_named_file(path), content_type='application/x-git-packed-objects')
+@gitview('GET', cache=True, etag=file_etag)
+def objects_pack_pack(request, backend=None, path=None, server=None, **kwargs):
+    return serve_file(request, server, os.path.join(backend.repo.controldir(), path), 'application/x-git-packed-objects')
 
 
-@gitview('GET', cache=True)
-def objects_pack_idx(request, backend=None, path=None, **kwargs):
-    return HttpResponse(backend.repo.get_named_file(path), content_type='application/x-git-packed-objects-toc')
+@gitview('GET', cache=True, etag=file_etag)
+def objects_pack_idx(request, backend=None, path=None, server=None, **kwargs):
+    return serve_file(request, server, os.path.join(backend.repo.controldir(), path), 'application/x-git-packed-objects-toc')
     
 
-@gitview('GET', cache=False)
+@gitview('GET', cache=False, etag=packs_etag)
 def objects_info_packs(request, backend=None, **kwargs):
     response = HttpResponse(content_type='text/plain')
     for pack in backend.repo.object_store.packs:
-        reponse.write('P pack-%s.pack\n' % pack.name())
+        response.write('P pack-%s.pack\n' % pack.name())
     return response
 
 
-@gitview('GET', cache=False)
+@gitview('GET', cache=False, etag=refs_etag)
 def info_refs(request, backend=None, **kwargs):
-    repo = backend.repo
     service = request.GET.get('service', None)
     if service:
         if service not in DEFAULT_HANDLERS:
             return HttpResponseForbidden('Unsupported service %s' % service)
-
-        handler_cls = DEFAULT_HANDLERS[service]
-        response = HttpResponse(content_type='application/x-%s-advertisement' % service)
-        proto = ReceivableProtocol(StringIO().read, response.write)
-        handler = handler_cls(WebBackend(), [backend], proto, stateless_rpc=True, advertise_refs=True)
-        handler.proto.write_pkt_line('# service=%s\n' % service)
-        handler.proto.write_pkt_line(None)
-        handler.handle()
+        content_type = 'application/x-%s-advertisement' % service
     else:
-        response = HttpResponse(content_type='text/plain')
-        refs = repo.get_refs()
-        for name in sorted(refs.iterkeys()):
-            if name == 'HEAD':
-                continue
-            hexsha = refs[name]
-            o = repo[hexsha]
-            if not o:
-                continue
-            response.write('%s\t%s\n' % (hexsha, name))
-            peeled_sha = repo.get_peeled(name)
-            if peeled_sha != hexsha:
-                response.write('%s\t%s^{}\n' % (peeled_sha, name))
-    return response
+        content_type = 'text/plain'
+    etag, data = get_advertisement(backend, service)
+    return HttpResponse(data, content_type=content_type)
 
 
 class PatchedUploadPackHandler(UploadPackHandler):
@@ -186,24 +314,176 @@ class PatchedUploadPackHandler(UploadPackHandler):
 
 @gitview('POST', cache=False)
 def git_upload_pack(request, backend=None, **kwargs):
-    response = HttpResponse(content_type='application/x-git-upload-pack-response')
-    
-    if request.META.get('HTTP_CONTENT_ENCODING') == 'gzip':
-        unzipped = GzipFile(mode='r', fileobj=StringIO(request.read()))
-        unzipped.seek(0)
-        read = unzipped.read
-    else:
-        read = request.read
-    
-    proto = ReceivableProtocol(read, response.write)
-    handler = PatchedUploadPackHandler(WebBackend(), [backend], proto, stateless_rpc=True)
-    handler.handle()
-    return response
+    # small requests are read up front, so clones can be served from the pack cache
+    chunks = iter_request_body(request)
+    head, size = [], 0
+    try:
+        for chunk in chunks:
+            head.append(chunk)
+            size += len(chunk)
+            if size > packcache.PACK_CACHE_MAX_REQUEST:
+                break
+    except RequestBodyTooLarge:
+        return HttpResponse(status=413)
+    key = None
+    if size <= packcache.PACK_CACHE_MAX_REQUEST:
+        key = packcache.get_cache_key(backend, ''.join(head))
+    if key:
+        f = packcache.open_cached(backend, key)
+        if f:
+            return HttpResponse(packcache.iter_cached(f), content_type='application/x-git-upload-pack-response')
+
+    def upload_pack(write):
+        # pooled repositories belong to the thread that leased them, and the
+        # request thread may serve the next request before the pack is sent
+        thread_backend = load_backend(backend.flavor, backend.path, cache=False)
+        proto = ReceivableProtocol(ChunkReader(itertools.chain(head, chunks)).read, write)
+        handler = PatchedUploadPackHandler(WebBackend(), [thread_backend], proto, stateless_rpc=True)
+        handler.handle()
+    # the pack is sent while it is generated
+    output = iter_thread_output(upload_pack)
+    if key:
+        output = packcache.iter_caching(backend, key, output)
+    return HttpResponse(output, content_type='application/x-git-upload-pack-response')
+
+
+class ChunkReader(object):
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += self.chunks.next()
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def iter_thread_output(target, max_chunks=16):
+    """
+    Runs `target(write)` in a thread and yields whatever it writes. The
+    thread blocks once `max_chunks` writes are pending and gives up with an
+    IOError when the generator is closed early, e.g. because the client
+    went away. Exceptions raised by `target` are re-raised by the generator.
+    """
+    queue = Queue.Queue(max_chunks)
+    state = {'closed': False}
+
+    def put(item):
+        while not state['closed']:
+            try:
+                queue.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def write(data):
+        if data and not put((data, None)):
+            raise IOError("response stream closed")
+
+    def run():
+        try:
+            target(write)
+        except Exception:
+            put((None, sys.exc_info()))
+        else:
+            put((None, None))
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            data, exc_info = queue.get()
+            if data is None:
+                if exc_info:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                return
+            yield data
+    finally:
+        state['closed'] = True
+
+
+# gzip request bodies are refused once they inflate to more than this
+MAX_INFLATED_SIZE = getattr(settings, 'VACUOUS_GIT_MAX_INFLATED_SIZE', 512 * 1024 * 1024)
+
+
+class RequestBodyTooLarge(Exception):
+    pass
+
+
+def iter_request_body(request, chunk_size=64 * 1024):
+    """
+    Yields the request body in chunks, inflated if it was sent with
+    `Content-Encoding: gzip`. Raises RequestBodyTooLarge once more than
+    `MAX_INFLATED_SIZE` bytes were inflated.
+    """
+    if request.META.get('HTTP_CONTENT_ENCODING') != 'gzip':
+        while True:
+            chunk = request.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+        return
+
+    # 16 + MAX_WBITS expects a gzip header
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    size = 0
+    while True:
+        if decompressor.unconsumed_tail:
+            data = decompressor.decompress(decompressor.unconsumed_tail, chunk_size)
+        else:
+            chunk = request.read(chunk_size)
+            if not chunk:
+                data = decompressor.flush()
+            else:
+                # never inflate more than `chunk_size` bytes at once
+                data = decompressor.decompress(chunk, chunk_size)
+        size += len(data)
+        if size > MAX_INFLATED_SIZE:
+            raise RequestBodyTooLarge()
+        if data:
+            yield data
+        if not chunk:
+            break
 
 
 @gitview('POST', cache=False, ssl=True, push=True)
 def git_receive_pack(request, backend=None, **kwargs):
-    result = ReceivePackTask.apply_async(args=[backend.flavor, backend.path, request.read()])
-    data, refs = result.wait()
-    post_push.send_robust(sender=type(backend), backend=backend, refs=refs)
-    return HttpResponse(data, content_type='application/x-git-receive-pack-response')
+    # only the path of the spooled pack goes through the broker
+    fd, spool_path = tempfile.mkstemp(dir=get_spool_dir(backend.repo), prefix='receive-')
+    f = os.fdopen(fd, 'wb')
+    try:
+        for chunk in iter_request_body(request):
+            f.write(chunk)
+    except RequestBodyTooLarge:
+        f.close()
+        os.remove(spool_path)
+        return HttpResponse(status=413)
+    except:
+        f.close()
+        os.remove(spool_path)
+        raise
+    f.close()
+    result = ReceivePackTask.apply_async(args=[backend.flavor, backend.path, spool_path])
+    data, refs, job_id = result.wait()
+    post_push.send_robust(sender=type(backend), backend=backend, refs=refs, job_id=job_id)
+    response = HttpResponse(data, content_type='application/x-git-receive-pack-response')
+    if job_id:
+        status_path = '%ssync/%s' % (request.path[:-len('git-receive-pack')], job_id)
+        response['X-Vacuous-Sync-Status'] = request.build_absolute_uri(status_path)
+    return response
+
+
+@gitview('GET', cache=False)
+def sync_status(request, backend=None, job_id=None, **kwargs):
+    status = SyncJob(job_id).status()
+    if status is None or status.get('repo') != backend.path:
+        raise Http404
+    return HttpResponse(simplejson.dumps(status), content_type='application/json')
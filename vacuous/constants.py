@@ -1,3 +1,5 @@
 WRITE = 'W'
 RENAME = 'R'
-DELETE = 'D'
\ No newline at end of file
+DELETE = 'D'
+# a blob that is already in the object store, referenced by its sha
+BLOB = 'B'
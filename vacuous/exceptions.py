@@ -8,3 +8,4 @@ class FileDoesNotExist(BackendError): pass
 class BranchDoesNotExist(BackendError): pass
 class BranchDoesAlreadyExist(BackendError): pass
 class CommitDoesNotExist(BackendError): pass
+class CommitConflict(BackendError): pass
@@ -0,0 +1,208 @@
+import sys
+import Queue
+import threading
+
+from django.conf import settings
+from django.utils.importlib import import_module
+
+from vacuous.backends import load_backend
+from vacuous.groupcommit import GroupCommitter
+from vacuous.exceptions import BranchDoesNotExist
+
+# coalesce concurrent commits to the same branch, see GroupCommitter
+GROUP_COMMITS = getattr(settings, 'VACUOUS_GROUP_COMMITS', True)
+
+
+def execute_commit(flavor, repo_path, changes, kwargs):
+    backend = load_backend(flavor, repo_path)
+    backend.changes = changes
+    commit = backend.do_commit(**kwargs)
+    return commit.revision
+
+
+def execute_commit_group(flavor, repo_path, branch, changesets):
+    backend = load_backend(flavor, repo_path)
+    commits = backend.do_commit_group(changesets, branch=branch)
+    return [commit.revision for commit in commits]
+
+
+def get_branch_tip(flavor, repo_path, branch):
+    backend = load_backend(flavor, repo_path, cache=False)
+    try:
+        return backend.revision(branch=branch).revision
+    except BranchDoesNotExist:
+        return None
+
+
+class CeleryExecutor(object):
+    """
+    Runs commits with celery. Concurrent commits to the same branch are
+    grouped before they are sent, so a group travels as one CommitGroupTask.
+    """
+    def __init__(self):
+        self.group_committer = GROUP_COMMITS and GroupCommitter(self.commit_group, self.commit_one, get_branch_tip) or None
+
+    def commit(self, flavor, repo_path, changes, kwargs):
+        # commits on top of an explicit parent can't be reordered
+        if self.group_committer and not kwargs.get('parent'):
+            return self.group_committer.commit(flavor, repo_path, changes, kwargs)
+        return self.commit_one(flavor, repo_path, changes, kwargs)
+
+    def commit_one(self, flavor, repo_path, changes, kwargs):
+        from vacuous.tasks import CommitTask
+        result = CommitTask.apply_async(
+            args=[flavor, repo_path, changes, kwargs],
+            routing_key='vacuous.repo.%s.commit' % flavor,
+        )
+        return result.wait()
+
+    def commit_group(self, flavor, repo_path, branch, changesets):
+        from vacuous.tasks import CommitGroupTask
+        result = CommitGroupTask.apply_async(
+            args=[flavor, repo_path, branch, changesets],
+            routing_key='vacuous.repo.%s.commit' % flavor,
+        )
+        return result.wait()
+
+
+class CommitJob(object):
+    def __init__(self, args):
+        self.args = args
+        self.result = None
+        self.exc_info = None
+        self.done = threading.Event()
+
+    @property
+    def group_key(self):
+        # None for commits that can't be grouped
+        kwargs = self.args[3]
+        if not GROUP_COMMITS or kwargs.get('parent'):
+            return None
+        return kwargs.get('branch')
+
+    def run(self):
+        try:
+            self.result = execute_commit(*self.args)
+        except Exception:
+            self.exc_info = sys.exc_info()
+        self.done.set()
+
+
+class SerialQueue(threading.Thread):
+    idle_timeout = 60
+
+    def __init__(self, executor, key):
+        super(SerialQueue, self).__init__(name='vacuous-commit-%s' % (key,))
+        self.daemon = True
+        self.executor = executor
+        self.key = key
+        self.jobs = Queue.Queue()
+
+    def run(self):
+        while True:
+            try:
+                jobs = [self.jobs.get(timeout=self.idle_timeout)]
+            except Queue.Empty:
+                with self.executor._lock:
+                    if self.jobs.empty():
+                        del self.executor._queues[self.key]
+                        return
+                continue
+            # whatever was queued while the last commit ran goes in one batch
+            while True:
+                try:
+                    jobs.append(self.jobs.get_nowait())
+                except Queue.Empty:
+                    break
+            self.executor.run_jobs(self.key, jobs)
+
+
+class LocalExecutor(object):
+    """
+    Runs commits in this process, without a broker. Commits to the same
+    repository are executed one after another by a worker thread, in the
+    order they were submitted, just like a dedicated celery queue would.
+    Consecutive commits to the same branch that queued up meanwhile are
+    written as one group.
+    """
+    def __init__(self):
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    def commit(self, flavor, repo_path, changes, kwargs):
+        key = (flavor, repo_path)
+        job = CommitJob((flavor, repo_path, dict(changes), dict(kwargs)))
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = self._queues[key] = SerialQueue(self, key)
+                queue.start()
+            queue.jobs.put(job)
+        job.done.wait()
+        if job.exc_info:
+            raise job.exc_info[0], job.exc_info[1], job.exc_info[2]
+        return job.result
+
+    def run_jobs(self, key, jobs):
+        group = []
+        for job in jobs + [None]:
+            if group and (job is None or job.group_key != group[0].group_key):
+                self._run_group(key, group)
+                group = []
+            if job is None:
+                break
+            if job.group_key is None:
+                job.run()
+            else:
+                group.append(job)
+
+    def _run_group(self, key, jobs):
+        if len(jobs) == 1:
+            jobs[0].run()
+            return
+        flavor, repo_path = key
+        changesets = []
+        for job in jobs:
+            kwargs = dict(job.args[3])
+            kwargs.pop('branch')
+            kwargs.pop('parent', None)
+            changesets.append((job.args[2], kwargs))
+        branch = jobs[0].group_key
+        tip = None
+        try:
+            tip = get_branch_tip(flavor, repo_path, branch)
+            revisions = self.commit_group(flavor, repo_path, branch, changesets)
+        except Exception:
+            exc_info = sys.exc_info()
+            try:
+                moved = get_branch_tip(flavor, repo_path, branch) != tip
+            except Exception:
+                moved = True
+            if not moved:
+                # nothing reached the branch, every caller gets the result
+                # (or the error) of its own commit
+                for job in jobs:
+                    job.run()
+                return
+            # the commits may be on the branch already, don't repeat them
+            for job in jobs:
+                job.exc_info = exc_info
+                job.done.set()
+            return
+        for job, revision in zip(jobs, revisions):
+            job.result = revision
+            job.done.set()
+
+    def commit_group(self, flavor, repo_path, branch, changesets):
+        return execute_commit_group(flavor, repo_path, branch, changesets)
+
+
+_executor = None
+
+def get_commit_executor():
+    global _executor
+    if _executor is None:
+        import_path = getattr(settings, 'VACUOUS_COMMIT_EXECUTOR', 'vacuous.executors.CeleryExecutor')
+        module_path, cls_name = import_path.rsplit('.', 1)
+        _executor = getattr(import_module(module_path), cls_name)()
+    return _executor
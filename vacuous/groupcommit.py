@@ -0,0 +1,80 @@
+import sys
+import threading
+
+
+class CommitGroup(object):
+    def __init__(self, lock):
+        self.lock = lock
+        self.changesets = []
+        self.revisions = None
+        self.exc_info = None
+        self.retry = False
+        self.done = threading.Event()
+
+
+class GroupCommitter(object):
+    """
+    Coalesces commits to the same branch of a repository. Commits that
+    arrive while a group of their branch is being written are collected and
+    written together as the next group by `commit_group(flavor, repo_path,
+    branch, changesets)`: every changeset still gets its own commit, but the
+    objects are stored together and the branch is updated once. Nobody
+    waits for a group to fill up, a lone commit is written right away.
+
+    If a group fails before it reached the branch, each of its callers
+    retries with `commit()` on its own, so only the bad changeset fails.
+    `get_tip(flavor, repo_path, branch)` tells whether the branch moved;
+    if it did, the commits may be on the branch already and the error is
+    raised for the whole group instead.
+    """
+    def __init__(self, commit_group, commit, get_tip):
+        self.commit_group = commit_group
+        self.commit_one = commit
+        self.get_tip = get_tip
+        self._groups = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def commit(self, flavor, repo_path, changes, kwargs):
+        kwargs = dict(kwargs)
+        branch = kwargs.pop('branch')
+        kwargs.pop('parent', None)
+        key = (flavor, repo_path, branch)
+        with self._lock:
+            group = self._groups.get(key)
+            if group is None:
+                group = self._groups[key] = CommitGroup(self._locks.setdefault(key, threading.Lock()))
+            index = len(group.changesets)
+            group.changesets.append((changes, kwargs))
+
+        # groups of the same branch are written one after another; whoever
+        # gets the lock first writes the group, the others find it done
+        with group.lock:
+            with self._lock:
+                leader = self._groups.get(key) is group
+                if leader:
+                    del self._groups[key]
+            if leader:
+                try:
+                    tip = self._get_tip(flavor, repo_path, branch)
+                    group.revisions = self.commit_group(flavor, repo_path, branch, group.changesets)
+                except Exception:
+                    group.exc_info = sys.exc_info()
+                    group.retry = len(group.changesets) > 1 and tip == self._get_tip(flavor, repo_path, branch)
+                finally:
+                    group.done.set()
+        group.done.wait()
+
+        if group.exc_info:
+            if not group.retry:
+                raise group.exc_info[0], group.exc_info[1], group.exc_info[2]
+            kwargs['branch'] = branch
+            return self.commit_one(flavor, repo_path, changes, kwargs)
+        return group.revisions[index]
+
+    def _get_tip(self, flavor, repo_path, branch):
+        try:
+            return self.get_tip(flavor, repo_path, branch)
+        except Exception:
+            # never equal to another tip, so nothing is retried
+            return object()
@@ -0,0 +1,61 @@
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+from vacuous.signals import post_sync_finished
+
+
+class SyncJob(object):
+    """
+    Tracks a sync running in the background with a counter of pending steps
+    in the cache. Every task increments the counter for the subtasks it
+    spawns before it decrements it for itself, so the counter only drops to
+    zero once everything is done.
+    """
+    timeout = getattr(settings, 'VACUOUS_SYNC_JOB_TIMEOUT', 24 * 3600)
+
+    def __init__(self, job_id):
+        self.id = job_id
+        self.key = 'vacuous.sync.%s' % job_id
+
+    @classmethod
+    def create(cls, steps, **info):
+        job = cls(uuid.uuid4().hex)
+        cache.set(job.key + '.info', info, cls.timeout)
+        cache.set(job.key + '.failed', 0, cls.timeout)
+        cache.set(job.key, steps, cls.timeout)
+        return job
+
+    def _incr(self, key, delta):
+        # the counters of an expired or evicted job are gone, there's nothing
+        # left to track
+        try:
+            return cache.incr(key, delta)
+        except ValueError:
+            return None
+
+    def add_steps(self, steps):
+        if steps:
+            self._incr(self.key, steps)
+
+    def add_failures(self, failures):
+        if failures:
+            self._incr(self.key + '.failed', failures)
+
+    def finish_step(self):
+        if self._incr(self.key, -1) == 0:
+            post_sync_finished.send_robust(sender=SyncJob, job=self, status=self.status())
+
+    def status(self):
+        pending = cache.get(self.key)
+        if pending is None:
+            return None
+        status = dict(cache.get(self.key + '.info') or {})
+        status.update({
+            'id': self.id,
+            'pending': pending,
+            'failed': cache.get(self.key + '.failed') or 0,
+            'finished': pending == 0,
+        })
+        return status
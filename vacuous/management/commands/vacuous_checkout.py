@@ -0,0 +1,15 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from vacuous.adapters import iter_adapters
+
+
+class Command(BaseCommand):
+    help = "Loads the files of a revision into the database"
+    option_list = BaseCommand.option_list + (
+        make_option('-r', dest='revision', help='the revision to check out, defaults to the branch head'),
+        make_option('--batch-size', dest='batch_size', type='int', default=500, help='the number of objects saved per transaction'),
+    )
+    def handle(self, revision=None, batch_size=500, **options):
+        for adapter in iter_adapters():
+            commit = adapter.checkout(revision, batch_size=batch_size)
+            self.stdout.write("checked out %s@%s for %s\n" % (adapter.repo, commit.revision, adapter.__name__))
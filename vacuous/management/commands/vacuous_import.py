@@ -0,0 +1,37 @@
+import sys
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from vacuous.adapters import iter_adapters
+from vacuous.backends import load_backend
+
+
+def iter_files(adapters, branch, chunk_size):
+    for adapter in adapters:
+        for obj in adapter.iter_objects(branch=branch, chunk_size=chunk_size):
+            a = adapter(obj)
+            if a.path:
+                yield a.path, a.data
+
+
+class Command(BaseCommand):
+    help = "Imports all objects in the database into their repositories, as one commit per branch"
+    option_list = BaseCommand.option_list + (
+        make_option('-m', dest='message', help='the commit message'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=1000, help='the number of rows loaded at once'),
+    )
+    def handle(self, message=None, chunk_size=1000, **options):
+        if not message:
+            self.stderr.write("You must provide a commit message.\n")
+            sys.exit(1)
+        repos = {}
+        for adapter in iter_adapters():
+            repos.setdefault((adapter.flavor, adapter.repo, adapter.branch), []).append(adapter)
+
+        for (flavor, repo, branch), adapters in repos.iteritems():
+            backend = load_backend(flavor, repo)
+            backend.init_repo()
+            def progress(count):
+                self.stdout.write("%s@%s: %s files\r" % (repo, branch, count))
+                self.stdout.flush()
+            commit = backend.import_files(iter_files(adapters, branch, chunk_size), message=message, branch=branch, progress=progress)
+            self.stdout.write("\nimported %s@%s as %s\n" % (repo, branch, commit.revision))
@@ -4,6 +4,7 @@ post_commit = Signal()
 post_push = Signal()
 post_pull = Signal()
 post_sync = Signal()
+post_sync_finished = Signal()
 
 post_create_branch = Signal()
 post_delete_branch = Signal()
@@ -1,38 +1,120 @@
 import hashlib
+from datetime import timedelta
 
-from celery.task import Task
+from celery.task import Task, PeriodicTask
+from celery.task.sets import TaskSet, subtask
+from django.conf import settings
 from django.core.cache import cache
 
 from vacuous.backends import load_backend
 from vacuous.adapters import iter_adapters
 from vacuous.signals import post_sync
+from vacuous.executors import execute_commit, execute_commit_group
+from vacuous.jobs import SyncJob
 
 
 class CommitTask(Task):
     def run(self, flavor, repo_path, changes, kwargs, **info):
-        lock_key = hashlib.sha1("%s#%s#%s" % (flavor, repo_path, kwargs['branch']))
-        backend = load_backend(flavor, repo_path)
-        backend.changes = changes
-        commit = backend.do_commit(**kwargs)
-        return commit.revision
+        return execute_commit(flavor, repo_path, changes, kwargs)
+
+
+class CommitGroupTask(Task):
+    def run(self, flavor, repo_path, branch, changesets, **info):
+        return execute_commit_group(flavor, repo_path, branch, changesets)
+
+
+SYNC_CHUNK_SIZE = getattr(settings, 'VACUOUS_SYNC_CHUNK_SIZE', 500)
 
 
 class SyncTask(Task):
-    def run(self, flavor, repo_path, oldrev, newrev, name):
+    def run(self, flavor, repo_path, oldrev, newrev, name, job_id=None):
+        job = job_id and SyncJob(job_id)
+        try:
+            self.sync(flavor, repo_path, oldrev, newrev, name, job)
+        finally:
+            if job:
+                job.finish_step()
+
+    def sync(self, flavor, repo_path, oldrev, newrev, name, job):
         backend = load_backend(flavor, repo_path, cache=False)
+        if not newrev.strip('0'):
+            return
+
+        changed, deleted = backend.sync_plan(oldrev.strip('0') and oldrev or None, newrev)
+        # ship revisions, not commits, to the subtasks
+        changed = sorted((path, commit.revision) for path, commit in changed.iteritems())
+        deleted = sorted(deleted)
+
+        chunks = (max(len(changed), len(deleted)) + SYNC_CHUNK_SIZE - 1) // SYNC_CHUNK_SIZE
+        tasks = []
+        for chunk in xrange(chunks):
+            start, end = chunk * SYNC_CHUNK_SIZE, (chunk + 1) * SYNC_CHUNK_SIZE
+            tasks.append(subtask(SyncChunkTask, args=[flavor, repo_path, name, dict(changed[start:end]), deleted[start:end]], kwargs={
+                'chunk': chunk,
+                'chunks': chunks,
+                'job_id': job and job.id,
+            }))
+        if tasks:
+            if job:
+                job.add_steps(len(tasks))
+            TaskSet(tasks=tasks).apply_async()
+
+
+class SyncChunkTask(Task):
+    def run(self, flavor, repo_path, branch, changed, deleted, chunk=0, chunks=1, job_id=None):
+        job = job_id and SyncJob(job_id)
+        failed = []
+        try:
+            backend = load_backend(flavor, repo_path, cache=False)
+            commits = dict((revision, backend.revision(revision)) for revision in set(changed.itervalues()))
+            changed = dict((path, commits[revision]) for path, revision in changed.iteritems())
+            for adapter in iter_adapters(flavor=flavor):
+                failed += [(path, unicode(e)) for path, e in adapter.sync_paths(repo_path, branch, changed, deleted, chunk=chunk, chunks=chunks, job_id=job_id)]
+        except:
+            if job:
+                job.add_failures(len(changed) + len(deleted))
+            raise
+        else:
+            if job:
+                job.add_failures(len(failed))
+        finally:
+            if job:
+                job.finish_step()
+        return failed
+
+
+def iter_repos():
+    repos = getattr(settings, 'VACUOUS_MAINTENANCE_REPOS', None)
+    if repos is None:
+        repos = set()
+        for adapter in iter_adapters():
+            if isinstance(adapter.flavor, basestring) and isinstance(adapter.repo, basestring):
+                repos.add((adapter.flavor, adapter.repo))
+    return repos
+
+
+class MaintenanceTask(PeriodicTask):
+    run_every = timedelta(seconds=getattr(settings, 'VACUOUS_MAINTENANCE_INTERVAL', 3600))
+
+    def run(self, **kwargs):
+        for flavor, repo_path in iter_repos():
+            RepoMaintenanceTask.apply_async(
+                args=[flavor, repo_path],
+                routing_key='vacuous.repo.%s.maintenance' % flavor,
+            )
+
 
-        commit_map = {}
-        for commit in backend.history(revision=newrev, since_revision=oldrev):
-            print commit
-            for path in commit.paths:
-                commit_map.setdefault(path, commit)
-        
-        paths = commit_map.keys()
-        print commit_map
-        for adapter in iter_adapters(flavor=flavor):
-            for obj in adapter.iter_objects(paths=paths):
-                print "syncing object", obj
-                a = adapter(obj)
-                a.sync(commit_map[a.path])
-                
-        
\ No newline at end of file
+class RepoMaintenanceTask(Task):
+    def run(self, flavor, repo_path, force=False, **info):
+        lock_key = 'vacuous.maintenance.%s' % hashlib.sha1("%s#%s" % (flavor, repo_path)).hexdigest()
+        # maintenance never locks out writers, but two runs on one repo would race
+        if not cache.add(lock_key, True, 6 * 3600):
+            return False
+        try:
+            backend = load_backend(flavor, repo_path, cache=False)
+            if not force and not backend.needs_maintenance():
+                return False
+            backend.maintain()
+            return True
+        finally:
+            cache.delete(lock_key)
@@ -27,6 +27,12 @@ class FooAdapter(Adapter):
     data = Adapter.proxy('data')
     revision = Adapter.proxy('revision')
 
+    @classmethod
+    def filter(cls, queryset, paths=None, branch=None):
+        if paths is not None:
+            queryset = queryset.filter(path__in=paths)
+        return queryset
+
 FooAdapter.register(Foo)
 
 class VcsSyncTests(TestCase):
@@ -146,5 +152,1235 @@ class VcsSyncTests(TestCase):
 
         backend.delete_repo()
         self.assertFalse(os.path.exists(self.TEST_REPO))
-        
-        
\ No newline at end of file
+
+    def test_path_history(self):
+        backend = load_backend('git', self.TEST_REPO)
+        backend.init_repo()
+
+        backend.write('a.txt', u"a")
+        backend.write('dir/b.txt', u"b")
+        backend.commit('first')
+        time.sleep(1)
+
+        backend.write('dir/b.txt', u"bb")
+        backend.commit('second')
+        time.sleep(1)
+
+        backend.write('a.txt', u"aa")
+        backend.commit('third')
+        time.sleep(1)
+
+        self.assertEqual(['third', 'first'], [c.message for c in backend.history('a.txt')])
+        self.assertEqual(['second', 'first'], [c.message for c in backend.history('dir')])
+        self.assertEqual(['second', 'first'], [c.message for c in backend.history('dir/b.txt')])
+        self.assertEqual([], backend.history('missing.txt'))
+        self.assertTrue(os.path.exists(backend.path_index.path))
+
+        backend.delete_repo()
+
+    def test_path_index(self):
+        from vacuous.backends.dulwich.index import PathIndex
+        backend = load_backend('git', self.TEST_REPO)
+        backend.init_repo()
+
+        # paths may contain anything but NUL and slashes
+        backend.write('a\nb.txt', u"a")
+        backend.write('c\rd.txt', u"c")
+        backend.commit('first')
+        backend.write('a\nb.txt', u"aa")
+        backend.commit('second')
+        self.assertEqual(['second', 'first'], [c.message for c in backend.history('a\nb.txt')])
+        self.assertEqual(['first'], [c.message for c in backend.history('c\rd.txt')])
+
+        # a record torn by a crash is skipped, the index is rebuilt
+        f = open(backend.path_index.path, 'ab')
+        f.write('%s a\0' % ('0' * 40))
+        f.close()
+        backend.write('c\rd.txt', u"cc")
+        backend.commit('third')
+        self.assertEqual(['third', 'first'], [c.message for c in backend.history('c\rd.txt')])
+        self.assertEqual(['second', 'first'], [c.message for c in backend.history('a\nb.txt')])
+        backend.write('a\nb.txt', u"aaa")
+        backend.commit('fourth')
+        index = PathIndex(backend.path_index.path)
+        index.refresh()
+        self.assertFalse(index.damaged)
+        self.assertEqual(['fourth', 'second', 'first'], [c.message for c in backend.history('a\nb.txt')])
+
+        # concurrent appends from several processes stay intact
+        path = os.path.join(self.TEST_REPO, 'test-index')
+        pids = []
+        for i in range(4):
+            pid = os.fork()
+            if not pid:
+                try:
+                    index = PathIndex(path)
+                    for j in range(50):
+                        index.append(['%040x %s' % (i * 100 + j, 'x' * 5000)])
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        index = PathIndex(path)
+        index.refresh()
+        self.assertFalse(index.damaged)
+        self.assertEqual(200, len(index.commits))
+
+        backend.delete_repo()
+
+    def test_paginated_history(self):
+        from vacuous.exceptions import CommitDoesNotExist
+
+        backend = load_backend('git', self.TEST_REPO)
+        backend.init_repo()
+
+        for i in range(5):
+            backend.write('test.txt', u"v%s" % i)
+            backend.commit('commit %s' % i)
+            time.sleep(1)
+
+        history = backend.history()
+        self.assertEqual(['commit 4', 'commit 3', 'commit 2', 'commit 1', 'commit 0'], [c.message for c in history])
+        self.assertEqual(['commit 3', 'commit 2'], [c.message for c in backend.history(offset=1, limit=2)])
+        self.assertEqual(['commit 1', 'commit 0'], [c.message for c in backend.history(after=history[2].revision)])
+        self.assertEqual(['commit 4', 'commit 3', 'commit 2'], [c.message for c in backend.history(since_revision=history[2].revision)])
+        self.assertEqual(['commit 2', 'commit 1'], [c.message for c in backend.history('test.txt', offset=2, limit=2)])
+
+        # cursors outside of the history are refused instead of skipping it all
+        backend.write('other.txt', u"other")
+        other = backend.commit('other')
+        self.assertEqual(['commit 1', 'commit 0'], [c.message for c in backend.history('test.txt', after=history[2])])
+        self.assertRaises(CommitDoesNotExist, backend.history, after='1' * 40)
+        self.assertRaises(CommitDoesNotExist, backend.history, 'test.txt', after=other)
+        self.assertRaises(CommitDoesNotExist, backend.history, revision=history[1].revision, after=other)
+        self.assertRaises(CommitDoesNotExist, backend.history, since_revision=history[2].revision, after=history[3].revision)
+
+        backend.delete_repo()
+
+    def test_ancestry(self):
+        backend = load_backend('git', self.TEST_REPO)
+        backend.init_repo()
+
+        backend.write('test.txt', u"base")
+        base = backend.commit('base')
+        time.sleep(1)
+
+        backend.create_branch('topic')
+        backend.write('test.txt', u"master")
+        r1 = backend.commit('master')
+        backend.write('other.txt', u"topic")
+        r2 = backend.commit('topic', branch='topic')
+
+        self.assertTrue(backend.is_ancestor(base, r1))
+        self.assertTrue(backend.is_ancestor(base, r2))
+        self.assertFalse(backend.is_ancestor(r1, r2))
+        self.assertFalse(backend.is_ancestor(r1, base))
+        self.assertEqual(base, backend.merge_base(r1, r2).revision)
+        self.assertEqual(base, backend.merge_base(base, r1).revision)
+
+        self.assertTrue(backend.touches(r1, 'test.txt'))
+        self.assertFalse(backend.touches(r1, 'other.txt'))
+        self.assertTrue(backend.touches(r2, 'other.txt'))
+
+        # bad records are skipped instead of breaking every walk
+        from vacuous.backends.dulwich.graph import CommitGraph
+        graph = backend.commit_graph
+        graph.append([
+            '%s 1 0 -' % ('1' * 40),
+            '%s 2 0 %s *' % ('2' * 40, '3' * 40),
+            '%s 1 0 - abc' % ('4' * 40),
+        ])
+        f = open(graph.path, 'ab')
+        f.write('%s 1 0 - *\n' % ('5' * 40))
+        f.close()
+        graph.refresh()
+        self.assertTrue(graph.damaged)
+        for sha in ('1', '2', '4', '5'):
+            self.assertFalse(sha * 40 in graph)
+        self.assertEqual(base, backend.merge_base(r1, r2).revision)
+
+        # and the graph is rebuilt by the next update
+        backend.write('test.txt', u"master 2")
+        r3 = backend.commit('master 2')
+        self.assertTrue(backend.is_ancestor(r1, r3))
+        graph = CommitGraph(graph.path)
+        graph.refresh()
+        self.assertFalse(graph.damaged)
+        self.assertEqual(3, graph.generation(r3))
+
+        backend.delete_repo()
+
+    def test_object_cache(self):
+        from vacuous.backends.dulwich.cache import object_cache
+
+        backend = load_backend('git', self.TEST_REPO)
+        backend.init_repo()
+        backend.write('foo/test.txt', u"cached")
+        revision = backend.commit('initial commit')
+
+        other = Backend(self.TEST_REPO)
+        self.assertEqual(other.read('foo/test.txt', revision=revision), u"cached")
+        hits = object_cache.hits
+        self.assertEqual(Backend(self.TEST_REPO).read('foo/test.txt', revision=revision), u"cached")
+        self.assertTrue(object_cache.hits > hits)
+
+        backend.delete_repo()
+
+    def test_repo_pool(self):
+        import tempfile, threading
+        from dulwich.repo import Repo
+        from vacuous.backends.dulwich.pool import RepoPool
+
+        class Owner(object):
+            pass
+
+        def make_pack(path, name):
+            open(os.path.join(path, 'objects', 'pack', name), 'w').close()
+
+        root = tempfile.mkdtemp()
+        try:
+            paths = []
+            for name in ('a.git', 'b.git', 'c.git'):
+                path = os.path.join(root, name)
+                os.mkdir(path)
+                Repo.init_bare(path)
+                paths.append(path)
+            pool = RepoPool(max_repos=2, max_fds=4)
+
+            a = Owner()
+            repo = pool.acquire(paths[0], a)
+            self.assertTrue(pool.acquire(paths[0], Owner()) is repo)
+            # other threads get handles of their own
+            other = []
+            thread = threading.Thread(target=lambda: other.append(pool.acquire(paths[0], Owner())))
+            thread.start()
+            thread.join()
+            self.assertFalse(other[0] is repo)
+            self.assertEqual(2, len(pool._entries))
+
+            # the idle handle goes first, the leased one stays
+            b = Owner()
+            pool.acquire(paths[1], b)
+            self.assertEqual(2, len(pool._entries))
+            self.assertTrue(pool.acquire(paths[0], a) is repo)
+
+            # released handles are closed in LRU order
+            del a
+            pool.acquire(paths[2], b)
+            self.assertEqual(set(paths[1:]), set(path for path, ident in pool._entries))
+
+            # every pack counts against the fd budget
+            for path in paths[1:]:
+                make_pack(path, 'pack-1.pack')
+                make_pack(path, 'pack-2.pack')
+            pool = RepoPool(max_repos=2, max_fds=4)
+            pool.acquire(paths[1], Owner())
+            pool.acquire(paths[2], Owner())
+            self.assertEqual([paths[2]], [path for path, ident in pool._entries])
+
+            # a repository that was created again gets a fresh handle
+            c = Owner()
+            repo = pool.acquire(paths[0], c)
+            shutil.rmtree(paths[0])
+            os.mkdir(paths[0])
+            Repo.init_bare(paths[0])
+            self.assertFalse(pool.acquire(paths[0], c) is repo)
+            # as does one with new packs
+            repo = pool.acquire(paths[0], c)
+            time.sleep(0.01)
+            make_pack(paths[0], 'pack-3.pack')
+            self.assertFalse(pool.acquire(paths[0], c) is repo)
+
+            pool.discard(paths[0])
+            self.assertFalse(paths[0] in [path for path, ident in pool._entries])
+        finally:
+            shutil.rmtree(root)
+
+    def test_pack_commit(self):
+        from dulwich.objects import Blob
+        from vacuous.constants import BLOB
+
+        backend = load_backend('git', self.TEST_REPO)
+        backend.init_repo()
+
+        for i in range(100):
+            backend.write('pages/%s.txt' % i, u"page %s" % i)
+        self.assertEqual((BLOB, Blob.from_string("page 0").id), backend.changes['pages/0.txt'])
+        revision = backend.commit('bulk commit')
+
+        # the blobs are stored by write(), ahead of the commit
+        packs = backend.repo.object_store.packs
+        self.assertEqual(1, len(packs))
+        self.assertTrue(Blob.from_string("page 42").id in packs[0])
+        self.assertEqual(backend.read('pages/42.txt'), u"page 42")
+        self.assertEqual(100, len(backend.revision(revision).paths))
+
+        backend.delete_repo()
+
+    def test_maintenance(self):
+        backend = load_backend('git', self.TEST_REPO)
+        backend.init_repo()
+
+        for i in range(3):
+            backend.write('test.txt', u"v%s" % i)
+            backend.commit('commit %s' % i)
+        backend.create_branch('v1')
+
+        backend.maintain()
+
+        objects_dir = os.path.join(self.TEST_REPO, 'objects')
+        loose = [name for name in os.listdir(objects_dir) if len(name) == 2 and os.listdir(os.path.join(objects_dir, name))]
+        self.assertEqual([], loose)
+        self.assertEqual(1, len(backend.repo.object_store.packs))
+        self.assertFalse(os.path.exists(os.path.join(self.TEST_REPO, 'refs', 'heads', 'master')))
+        self.assertEqual(backend.read('test.txt'), u"v2")
+        self.assertEqual(backend.read('test.txt', branch='v1'), u"v2")
+        self.assertEqual(3, len(backend.history()))
+
+        backend.delete_repo()
+
+    def test_pack_refs(self):
+        from vacuous.backends.dulwich.maintenance import pack_refs
+        backend = load_backend('git', self.TEST_REPO)
+        backend.init_repo()
+        backend.write('a.txt', u"a")
+        backend.commit('first')
+        backend.write('b.txt', u"b")
+        backend.commit('second')
+        backend.create_branch('v1')
+        backend.create_branch('v2')
+        # packed-refs is read and cached by the long-lived backend
+        self.assertTrue(backend.has_branch('v1'))
+
+        # a ref that is being updated stays loose
+        lock_path = os.path.join(self.TEST_REPO, 'refs', 'heads', 'v2.lock')
+        open(lock_path, 'w').close()
+        other = load_backend('git', self.TEST_REPO, cache=False)
+        other.maintain()
+        os.remove(lock_path)
+        self.assertFalse(os.path.exists(os.path.join(self.TEST_REPO, 'refs', 'heads', 'master')))
+        self.assertTrue(os.path.exists(os.path.join(self.TEST_REPO, 'refs', 'heads', 'v2')))
+
+        # the stale backend commits on top of the packed branch
+        backend.write('c.txt', u"c")
+        backend.commit('third')
+        self.assertEqual(3, len(backend.history()))
+        self.assertEqual(u"a", backend.read('a.txt'))
+        other = load_backend('git', self.TEST_REPO, cache=False)
+        self.assertEqual(['third', 'second', 'first'], [c.message for c in other.history()])
+
+        # deleting a packed branch removes it from packed-refs
+        pack_refs(other.repo)
+        backend.delete_branch('v1')
+        self.assertFalse(load_backend('git', self.TEST_REPO, cache=False).has_branch('v1'))
+        self.assertTrue(backend.has_branch('v2'))
+
+        backend.delete_repo()
+
+    def test_repack_deltas(self):
+        import random
+        backend = load_backend('git', self.TEST_REPO)
+        backend.init_repo()
+
+        rand = random.Random(42)
+        lines = ['%x\n' % rand.getrandbits(128) for i in xrange(1000)]
+        for i in range(10):
+            lines[rand.randrange(len(lines))] = 'changed %s\n' % i
+            backend.write('dir/test.txt', u''.join(lines))
+            backend.commit('commit %s' % i)
+        size = len(''.join(lines))
+
+        backend.maintain()
+
+        pack_dir = backend.repo.object_store.pack_dir
+        packs = [name for name in os.listdir(pack_dir) if name.endswith('.pack')]
+        self.assertEqual(1, len(packs))
+        # ten versions, but stored little more than once
+        self.assertTrue(os.path.getsize(os.path.join(pack_dir, packs[0])) < 2 * size)
+        self.assertEqual(u''.join(lines), backend.read('dir/test.txt'))
+        self.assertEqual(10, len(set(backend.read('dir/test.txt', revision=commit.revision) for commit in backend.history())))
+
+        backend.delete_repo()
+
+    def test_group_commit(self):
+        import threading
+        from vacuous.groupcommit import GroupCommitter
+        from vacuous.executors import execute_commit, execute_commit_group, get_branch_tip
+        from vacuous.constants import WRITE, RENAME
+
+        backend = load_backend('git', self.TEST_REPO)
+        backend.init_repo()
+        backend.write('test.txt', u"base")
+        base = backend.commit('base')
+
+        sizes = []
+        failures = []
+        started, proceed = threading.Event(), threading.Event()
+        def commit_group(flavor, repo_path, branch, changesets):
+            sizes.append(len(changesets))
+            started.set()
+            proceed.wait()
+            revisions = execute_commit_group(flavor, repo_path, branch, changesets)
+            if failures and len(changesets) > 1:
+                raise failures.pop()
+            return revisions
+        committer = GroupCommitter(commit_group, execute_commit, get_branch_tip)
+
+        results = {}
+        def commit(i, changes):
+            try:
+                results[i] = committer.commit('git', self.TEST_REPO, changes, {'message': 'page %s' % i, 'branch': 'master'})
+            except Exception, e:
+                results[i] = e
+        def start(i, changes):
+            thread = threading.Thread(target=commit, args=(i, changes))
+            thread.start()
+            return thread
+
+        # a lone commit is written right away, the ones arriving meanwhile
+        # are written together
+        threads = [start(0, {'page0.txt': (WRITE, 'page 0')})]
+        started.wait()
+        for i in range(1, 4):
+            threads.append(start(i, {'page%s.txt' % i: (WRITE, 'page %s' % i)}))
+        while sum(len(group.changesets) for group in committer._groups.values()) < 3:
+            time.sleep(0.01)
+        proceed.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([1, 3], sizes)
+        history = backend.history()
+        self.assertEqual(5, len(history))
+        self.assertEqual(base, history[-1].revision)
+        self.assertEqual([results[i] for i in range(3, -1, -1)], [c.revision for c in history[:4]])
+        for i in range(4):
+            self.assertEqual(['page%s.txt' % i], backend.revision(results[i]).paths)
+            self.assertEqual(u"page %s" % i, backend.read('page%s.txt' % i))
+
+        # a bad changeset only fails its own commit
+        started.clear()
+        proceed.clear()
+        threads = [start(4, {'page4.txt': (WRITE, 'page 4')})]
+        started.wait()
+        threads.append(start(5, {'moved.txt': (RENAME, 'missing.txt')}))
+        threads.append(start(6, {'page6.txt': (WRITE, 'page 6')}))
+        while sum(len(group.changesets) for group in committer._groups.values()) < 2:
+            time.sleep(0.01)
+        proceed.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([1, 3, 1, 2], sizes)
+        self.assertTrue(isinstance(results[5], KeyError))
+        self.assertEqual(u"page 6", backend.read('page6.txt'))
+        self.assertEqual(results[6], backend.revision().revision)
+
+        # a group that fails after it moved the branch isn't written again
+        started.clear()
+        proceed.clear()
+        threads = [start(7, {'page7.txt': (WRITE, 'page 7')})]
+        started.wait()
+        failures.append(RuntimeError("index update failed"))
+        threads.append(start(8, {'page8.txt': (WRITE, 'page 8')}))
+        threads.append(start(9, {'page9.txt': (WRITE, 'page 9')}))
+        while sum(len(group.changesets) for group in committer._groups.values()) < 2:
+            time.sleep(0.01)
+        proceed.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([1, 3, 1, 2, 1, 2], sizes)
+        self.assertTrue(isinstance(results[8], RuntimeError))
+        self.assertTrue(isinstance(results[9], RuntimeError))
+        messages = [c.message for c in backend.history()]
+        self.assertEqual(['page 7', 'page 8', 'page 9'], sorted(messages[:3]))
+        self.assertEqual(1, messages.count('page 8'))
+
+        backend.delete_repo()
+
+    def test_commit_conflict(self):
+        from vacuous.exceptions import CommitConflict
+
+        backend = load_backend('git', self.TEST_REPO)
+        backend.init_repo()
+        backend.write('a.txt', u"a")
+        backend.write('b.txt', u"b")
+        r0 = backend.commit('base')
+        backend.write('b.txt', u"b1")
+        r1 = backend.commit('concurrent')
+
+        # built on r0, replayed on top of r1
+        backend.write('a.txt', u"a1")
+        r2 = backend.commit('replayed', parent=r0)
+        self.assertEqual(r1, backend.revision(r2).parent_revision)
+        self.assertEqual(u"a1", backend.read('a.txt'))
+        self.assertEqual(u"b1", backend.read('b.txt'))
+
+        backend.write('b.txt', u"b2")
+        self.assertRaises(CommitConflict, backend.commit, 'conflict', parent=r0)
+        self.assertEqual(r2, backend.revision().revision)
+
+        # a directory that became a file is a conflict, too
+        backend.rollback()
+        backend.write('dir', u"file")
+        r3 = backend.commit('file')
+        backend.write('dir/c.txt', u"c")
+        self.assertRaises(CommitConflict, backend.commit, 'directory', parent=r2)
+        self.assertEqual(r3, backend.revision().revision)
+
+        backend.delete_repo()
+
+    def test_local_executor(self):
+        import sys, threading, traceback
+        from vacuous.executors import LocalExecutor, SerialQueue
+        from vacuous.constants import WRITE, RENAME
+
+        backend = load_backend('git', self.TEST_REPO)
+        backend.init_repo()
+
+        class RecordingExecutor(LocalExecutor):
+            def __init__(self):
+                super(RecordingExecutor, self).__init__()
+                self.batches = []
+                self.sizes = []
+                self.proceed = threading.Event()
+                self.proceed.set()
+                self.failures = []
+
+            def run_jobs(self, key, jobs):
+                self.batches.append(len(jobs))
+                self.proceed.wait()
+                super(RecordingExecutor, self).run_jobs(key, jobs)
+
+            def commit_group(self, flavor, repo_path, branch, changesets):
+                self.sizes.append(len(changesets))
+                revisions = super(RecordingExecutor, self).commit_group(flavor, repo_path, branch, changesets)
+                if self.failures:
+                    raise self.failures.pop()
+                return revisions
+
+        executor = RecordingExecutor()
+        results = {}
+        def commit(i, changes):
+            try:
+                results[i] = executor.commit('git', self.TEST_REPO, changes, {'message': 'page %s' % i, 'branch': 'master'})
+            except Exception, e:
+                results[i] = e
+        def submit(i, changes, batches):
+            # returns once the job is queued behind `batches` running batches
+            thread = threading.Thread(target=commit, args=(i, changes))
+            thread.start()
+            while True:
+                queue = executor._queues.get(('git', self.TEST_REPO))
+                if queue and len(executor.batches) == batches and sum(executor.batches) + queue.jobs.qsize() >= count[0] + 1:
+                    break
+                time.sleep(0.01)
+            count[0] += 1
+            return thread
+        count = [0]
+
+        # commits queued while another one runs are written as one group, in
+        # the order they were submitted
+        executor.proceed.clear()
+        threads = [submit(0, {'page.txt': (WRITE, 'page 0')}, 1)]
+        for i in range(1, 4):
+            threads.append(submit(i, {'page.txt': (WRITE, 'page %s' % i)}, 1))
+        executor.proceed.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([1, 3], executor.batches)
+        self.assertEqual([3], executor.sizes)
+        self.assertEqual(['page 3', 'page 2', 'page 1', 'page 0'], [c.message for c in backend.history()])
+        self.assertEqual([results[i] for i in range(3, -1, -1)], [c.revision for c in backend.history()])
+        self.assertEqual(u"page 3", backend.read('page.txt'))
+
+        # errors are raised in the caller, with the original traceback
+        changes = {'moved.txt': (RENAME, 'missing.txt')}
+        try:
+            executor.commit('git', self.TEST_REPO, changes, {'message': 'broken', 'branch': 'master'})
+        except KeyError:
+            frames = [frame[2] for frame in traceback.extract_tb(sys.exc_info()[2])]
+            self.assertTrue('_apply' in frames)
+        else:
+            self.fail("KeyError not raised")
+        count[0] += 1
+
+        # a bad changeset in a group only fails its own commit
+        executor.proceed.clear()
+        threads = [submit(10, {'a.txt': (WRITE, 'a')}, 4)]
+        threads.append(submit(11, changes, 4))
+        threads.append(submit(12, {'b.txt': (WRITE, 'b')}, 4))
+        executor.proceed.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([1, 3, 1, 1, 2], executor.batches)
+        self.assertEqual([3, 2], executor.sizes)
+        self.assertTrue(isinstance(results[11], KeyError))
+        self.assertEqual(u"a", backend.read('a.txt'))
+        self.assertEqual(results[12], backend.revision().revision)
+
+        # a group that fails after it moved the branch isn't written again
+        executor.proceed.clear()
+        executor.failures.append(RuntimeError("index update failed"))
+        threads = [submit(13, {'c.txt': (WRITE, 'c')}, 6)]
+        threads.append(submit(14, {'d.txt': (WRITE, 'd')}, 6))
+        threads.append(submit(15, {'e.txt': (WRITE, 'e')}, 6))
+        executor.proceed.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([1, 3, 1, 1, 2, 1, 2], executor.batches)
+        self.assertEqual([3, 2, 2], executor.sizes)
+        self.assertTrue(isinstance(results[14], RuntimeError))
+        self.assertTrue(isinstance(results[15], RuntimeError))
+        messages = [c.message for c in backend.history()]
+        self.assertEqual(['page 15', 'page 14', 'page 13'], messages[:3])
+        self.assertEqual(1, messages.count('page 14'))
+
+        # idle worker threads go away
+        idle_timeout = SerialQueue.idle_timeout
+        SerialQueue.idle_timeout = 0.05
+        try:
+            executor = LocalExecutor()
+            executor.commit('git', self.TEST_REPO, {'c.txt': (WRITE, 'c')}, {'message': 'c', 'branch': 'master'})
+            thread = executor._queues[('git', self.TEST_REPO)]
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+            self.assertEqual({}, executor._queues)
+        finally:
+            SerialQueue.idle_timeout = idle_timeout
+
+        backend.delete_repo()
+
+    def test_unchanged_commit(self):
+        backend = load_backend('git', self.TEST_REPO)
+        backend.init_repo()
+        backend.write('a.txt', u"a")
+        backend.write('dir/b.txt', u"b")
+        r0 = backend.commit('initial commit')
+
+        backend.write('a.txt', u"a")
+        self.assertEqual(r0, backend.commit('no-op'))
+        self.assertEqual(1, len(backend.history()))
+
+        backend.write('a.txt', u"a")
+        backend.write('dir/b.txt', u"bb")
+        r1 = backend.commit('one change')
+        self.assertEqual(['dir/b.txt'], backend.revision(r1).paths)
+
+        backend.write('a.txt', u"a")
+        r2 = backend.commit('forced', force=True)
+        self.assertNotEqual(r1, r2)
+        self.assertEqual(3, len(backend.history()))
+
+        backend.delete_repo()
+
+    def test_commit_many(self):
+        import datetime
+        from vacuous.constants import WRITE, DELETE
+
+        backend = load_backend('git', self.TEST_REPO)
+        backend.init_repo()
+
+        when = datetime.datetime(2010, 1, 1, 12, 0)
+        commits = backend.commit_many([
+            ({'a.txt': (WRITE, 'a'), 'dir/b.txt': (WRITE, 'b')}, 'first', 'Alice <alice@example.com>', when),
+            ({'a.txt': (WRITE, 'a2')}, 'second', 'Bob <bob@example.com>', when + datetime.timedelta(hours=1)),
+            ({'dir/b.txt': (DELETE, None)}, 'third', None, None),
+        ])
+        self.assertEqual(['first', 'second', 'third'], [c.message for c in commits])
+        self.assertEqual(commits[-1].revision, backend.revision().revision)
+        self.assertEqual(['third', 'second', 'first'], [c.message for c in backend.history()])
+        self.assertEqual(['dir/b.txt'], commits[2].paths)
+        self.assertEqual(u"a", backend.read('a.txt', revision=commits[0].revision))
+        self.assertEqual(u"a2", backend.read('a.txt'))
+        self.assertRaises(FileDoesNotExist, backend.read, 'dir/b.txt')
+        self.assertEqual(1, len(backend.repo.object_store.packs))
+
+        # unicode data is encoded like write() does
+        backend.commit_many([({'u.txt': (WRITE, u"\xe4")}, 'unicode', None, None)])
+        self.assertEqual(u"\xe4", backend.read('u.txt'))
+
+        backend.delete_repo()
+
+    def test_commit_many_rename(self):
+        from vacuous.constants import WRITE, RENAME, DELETE
+
+        backend = load_backend('git', self.TEST_REPO)
+        backend.init_repo()
+        backend.commit_many([
+            ({'a/b.txt': (WRITE, 'hello'), 'd/e.txt': (WRITE, 'e')}, 'first', None, None),
+            ({'c': (RENAME, 'a'), 'd': (DELETE, None)}, 'second', None, None),
+        ])
+        self.assertEqual(u"hello", backend.read('c/b.txt'))
+        self.assertRaises(FileDoesNotExist, backend.read, 'a/b.txt')
+        self.assertRaises(FileDoesNotExist, backend.read, 'd/e.txt')
+
+        backend.delete_repo()
+
+    def test_lookup_path(self):
+        from vacuous.backends.dulwich.cache import tree_entry_cache
+        from vacuous.backends.dulwich.utils import lookup_path
+
+        backend = load_backend('git', self.TEST_REPO)
+        backend.init_repo()
+        backend.write('a/b/c.txt', u"c")
+        backend.commit('initial commit')
+        objects = backend.objects
+        tree = backend.revision()._commit.tree
+        tree_entry_cache.clear()
+
+        mode, sha = lookup_path(objects, tree, 'a/b/c.txt')
+        self.assertEqual(backend.file_mode, mode)
+        self.assertEqual("c", objects[sha].as_raw_string())
+        self.assertEqual((mode, sha), tree_entry_cache.get((tree, 'a/b/c.txt')))
+        self.assertEqual(backend.directory_mode & 0170000, lookup_path(objects, tree, 'a/b')[0] & 0170000)
+        # misses are cached as well
+        self.assertEqual(None, lookup_path(objects, tree, 'a/x.txt'))
+        self.assertEqual((None, None), tree_entry_cache.get((tree, 'a/x.txt')))
+        self.assertEqual(None, lookup_path(objects, tree, 'a/b/c.txt/d'))
+        # the head of a commit is primed by the commit
+        backend.write('a/b/c.txt', u"c2")
+        backend.commit('second commit')
+        tree = backend.revision()._commit.tree
+        self.assertTrue(tree_entry_cache.get((tree, 'a/b/c.txt')))
+
+        backend.delete_repo()
+
+    def test_import(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+
+        backend = load_backend('git', 'foo.git')
+        backend.init_repo()
+        for i in range(5):
+            Foo.objects.create(path='pages/%s/page.txt' % (i % 2), data=u'page %s' % i)
+        Foo.objects.create(path='index.txt', data=u'index')
+        backend.rollback()
+
+        self.assertEqual(6, len(list(FooAdapter.iter_objects(chunk_size=4))))
+        call_command('vacuous_import', message='import', chunk_size=4, stdout=StringIO())
+
+        self.assertEqual(1, len(backend.history()))
+        self.assertEqual(u"index", backend.read('index.txt'))
+        self.assertEqual(u"page 4", backend.read('pages/0/page.txt'))
+        self.assertEqual(u"page 3", backend.read('pages/1/page.txt'))
+        self.assertEqual(['index.txt', 'pages/0/page.txt', 'pages/1/page.txt'], sorted(backend.revision().paths))
+
+        Foo.objects.all().delete()
+        backend.rollback()
+        backend.delete_repo()
+
+    def test_checkout(self):
+        from vacuous.signals import post_sync
+
+        backend = load_backend('git', 'foo.git')
+        backend.init_repo()
+        backend.write('a.txt', u"a")
+        backend.write('dir/b.txt', u"b")
+        revision = backend.commit('initial commit')
+        f0 = Foo.objects.create(path='a.txt', data=u'old')
+        backend.rollback()
+
+        synced = []
+        def receiver(sender, **kwargs):
+            synced.extend(kwargs['instances'])
+        post_sync.connect(receiver, sender=Foo)
+        try:
+            FooAdapter.checkout(batch_size=1)
+        finally:
+            post_sync.disconnect(receiver, sender=Foo)
+
+        self.assertFalse(backend.is_dirty())
+        self.assertEqual(2, len(synced))
+        self.assertEqual(u"a", Foo.objects.get(pk=f0.pk).data)
+        self.assertEqual(revision, Foo.objects.get(pk=f0.pk).revision)
+        self.assertEqual(u"b", Foo.objects.get(path='dir/b.txt').data)
+        self.assertEqual(1, len(backend.history()))
+
+        # data is decoded with the adapter's encoding
+        backend.write('c.txt', u"\xe4")
+        backend.commit('second commit')
+        FooAdapter.encoding = 'latin-1'
+        try:
+            FooAdapter.checkout()
+        finally:
+            del FooAdapter.encoding
+        self.assertEqual(u"\xc3\xa4", Foo.objects.get(path='c.txt').data)
+
+        # objects are only created for the paths the adapter owns
+        from vacuous.adapters.base import _adapters
+        backend.write('dir/d.txt', u"d")
+        backend.write('e.txt', u"e")
+        backend.commit('third commit')
+        FooAdapter.owns_path = classmethod(lambda cls, path: not path.startswith('dir/'))
+        try:
+            FooAdapter.checkout()
+        finally:
+            del FooAdapter.owns_path
+        self.assertFalse(Foo.objects.filter(path='dir/d.txt').exists())
+        self.assertEqual(u"e", Foo.objects.get(path='e.txt').data)
+        self.assertTrue(FooAdapter.owns_path('dir/d.txt'))
+        class OtherAdapter(object):
+            flavor, repo, branch = 'git', 'foo.git', 'master'
+        _adapters.add(OtherAdapter)
+        try:
+            self.assertFalse(FooAdapter.owns_path('dir/d.txt'))
+            FooAdapter.checkout()
+        finally:
+            _adapters.discard(OtherAdapter)
+        self.assertFalse(Foo.objects.filter(path='dir/d.txt').exists())
+
+        # adapters that pick the repository per object can't check out
+        FooAdapter.repo = property(lambda self: 'foo.git')
+        try:
+            self.assertRaises(TypeError, FooAdapter.checkout)
+        finally:
+            FooAdapter.repo = 'foo.git'
+
+        Foo.objects.all().delete()
+        backend.rollback()
+        backend.delete_repo()
+
+    def test_sync_plan(self):
+        backend = load_backend('git', self.TEST_REPO)
+        backend.init_repo()
+        backend.write('a.txt', u"a")
+        backend.write('dir/b.txt', u"b")
+        backend.write('dir/c.txt', u"c")
+        r0 = backend.commit('first')
+        time.sleep(1)
+        backend.write('a.txt', u"a1")
+        r1 = backend.commit('second')
+        time.sleep(1)
+        backend.delete('dir/b.txt')
+        backend.write('d.txt', u"d")
+        r2 = backend.commit('third')
+
+        changed, deleted = backend.sync_plan(r0, r2)
+        self.assertEqual({'a.txt': r1, 'd.txt': r2}, dict((path, c.revision) for path, c in changed.iteritems()))
+        self.assertEqual(set(['dir/b.txt']), deleted)
+
+        changed, deleted = backend.sync_plan(None, r1)
+        self.assertEqual({'a.txt': r1, 'dir/b.txt': r0, 'dir/c.txt': r0}, dict((path, c.revision) for path, c in changed.iteritems()))
+        self.assertEqual(set(), deleted)
+
+        # going back reports the files that only exist on the old side as deleted
+        changed, deleted = backend.sync_plan(r2, r0)
+        self.assertEqual({'a.txt': r0, 'dir/b.txt': r0}, dict((path, c.revision) for path, c in changed.iteritems()))
+        self.assertEqual(set(['d.txt']), deleted)
+
+        backend.delete_repo()
+
+    def test_sync_task(self):
+        from vacuous import tasks
+        from vacuous.jobs import SyncJob
+        from vacuous.signals import post_sync, post_sync_finished
+
+        backend = load_backend('git', 'foo.git')
+        backend.init_repo()
+        backend.write('a.txt', u"a")
+        backend.write('b.txt', u"b")
+        r0 = backend.commit('first')
+        f0 = Foo.objects.create(path='a.txt', data=u'a')
+        Foo.objects.create(path='b.txt', data=u'b')
+        backend.rollback()
+
+        backend.write('a.txt', u"a1")
+        backend.write('c.txt', u"c")
+        backend.delete('b.txt')
+        r1 = backend.commit('second')
+
+        chunks, finished = [], []
+        def receiver(sender, **kwargs):
+            chunks.append((kwargs['chunk'], kwargs['chunks'], len(kwargs['instances']), kwargs['failed']))
+        def finished_receiver(sender, **kwargs):
+            finished.append(kwargs['status'])
+        post_sync.connect(receiver, sender=Foo)
+        post_sync_finished.connect(finished_receiver)
+        chunk_size, tasks.SYNC_CHUNK_SIZE = tasks.SYNC_CHUNK_SIZE, 1
+        job = SyncJob.create(1, repo='foo.git')
+        try:
+            tasks.SyncTask().run('git', 'foo.git', r0, r1, 'master', job_id=job.id)
+        finally:
+            tasks.SYNC_CHUNK_SIZE = chunk_size
+            post_sync.disconnect(receiver, sender=Foo)
+            post_sync_finished.disconnect(finished_receiver)
+
+        self.assertEqual([(0, 2, 1, []), (1, 2, 0, [])], chunks)
+        self.assertEqual([job.status()], finished)
+        self.assertTrue(job.status()['finished'])
+        self.assertEqual(0, job.status()['failed'])
+        self.assertEqual(u"a1", Foo.objects.get(pk=f0.pk).data)
+        self.assertFalse(Foo.objects.filter(path='b.txt').exists())
+        self.assertFalse(backend.is_dirty())
+
+        Foo.objects.all().delete()
+        backend.rollback()
+        backend.delete_repo()
+
+    def test_sync_job_expired(self):
+        from vacuous import tasks
+        from vacuous.jobs import SyncJob
+        job = SyncJob('expired')
+        job.add_steps(2)
+        job.add_failures(1)
+        job.finish_step()
+        self.assertEqual(None, job.status())
+        # tasks of an expired job still run to the end
+        self.assertEqual([], tasks.SyncChunkTask().run('git', 'foo.git', 'master', {}, [], job_id=job.id))
+
+    def test_sync_shared_path(self):
+        from vacuous import tasks
+        from vacuous.adapters.base import suppress_post_save
+
+        foo = load_backend('git', 'foo.git')
+        foo.init_repo()
+        bar = load_backend('git', 'bar.git')
+        bar.init_repo()
+        bar.write('a.txt', u"bar 1")
+        r0 = bar.commit('first')
+
+        # two objects at the same path, one in each repository
+        repos = {}
+        FooAdapter.repo = property(lambda self: repos.get(self.obj.pk, 'foo.git'))
+        try:
+            with suppress_post_save():
+                f = Foo.objects.create(path='a.txt', data=u'foo')
+                b = Foo.objects.create(path='a.txt', data=u'bar')
+            repos[b.pk] = 'bar.git'
+
+            tasks.SyncChunkTask().run('git', 'bar.git', 'master', {'a.txt': r0}, [])
+            self.assertEqual(u"foo", Foo.objects.get(pk=f.pk).data)
+            self.assertEqual(u"bar 1", Foo.objects.get(pk=b.pk).data)
+
+            tasks.SyncChunkTask().run('git', 'bar.git', 'other', {}, ['a.txt'])
+            self.assertEqual(2, Foo.objects.filter(path='a.txt').count())
+
+            tasks.SyncChunkTask().run('git', 'bar.git', 'master', {}, ['a.txt'])
+            self.assertTrue(Foo.objects.filter(pk=f.pk).exists())
+            self.assertFalse(Foo.objects.filter(pk=b.pk).exists())
+        finally:
+            FooAdapter.repo = 'foo.git'
+            with suppress_post_save():
+                Foo.objects.all().delete()
+            bar.delete_repo()
+            foo.delete_repo()
+
+    def test_parse_range(self):
+        from vacuous.backends.dulwich.views import parse_range
+        self.assertEqual(parse_range(None, 100), None)
+        self.assertEqual(parse_range('bytes=0-9', 100), (0, 9))
+        self.assertEqual(parse_range('bytes=90-', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=-10', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=50-500', 100), (50, 99))
+        self.assertEqual(parse_range('bytes=0-1,5-9', 100), None)
+        self.assertEqual(parse_range('bytes=100-', 100), False)
+
+    def test_serve_file(self):
+        from django.test.client import RequestFactory
+        from vacuous.backends.dulwich.views import GitServer, serve_text_file, objects_pack_pack
+        backend = load_backend('git', self.TEST_REPO)
+        backend.init_repo()
+        backend.write('a.txt', u"a")
+        backend.commit('initial commit')
+        server = GitServer()
+        head = open(os.path.join(self.TEST_REPO, 'HEAD'), 'rb').read()
+        size = len(head)
+
+        response = serve_text_file(RequestFactory().get('/HEAD'), backend=backend, path='HEAD', server=server)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(head, ''.join(response))
+        self.assertEqual(str(size), response['Content-Length'])
+        self.assertEqual('bytes', response['Accept-Ranges'])
+        self.assertFalse(response.has_header('Content-Range'))
+
+        response = serve_text_file(RequestFactory().get('/HEAD', HTTP_RANGE='bytes=5-9'), backend=backend, path='HEAD', server=server)
+        self.assertEqual(206, response.status_code)
+        self.assertEqual(head[5:10], ''.join(response))
+        self.assertEqual('5', response['Content-Length'])
+        self.assertEqual('bytes 5-9/%s' % size, response['Content-Range'])
+
+        response = serve_text_file(RequestFactory().get('/HEAD', HTTP_RANGE='bytes=-4'), backend=backend, path='HEAD', server=server)
+        self.assertEqual(206, response.status_code)
+        self.assertEqual(head[-4:], ''.join(response))
+        self.assertEqual('bytes %s-%s/%s' % (size - 4, size - 1, size), response['Content-Range'])
+
+        response = serve_text_file(RequestFactory().get('/HEAD', HTTP_RANGE='bytes=%s-' % size), backend=backend, path='HEAD', server=server)
+        self.assertEqual(416, response.status_code)
+        self.assertEqual('bytes */%s' % size, response['Content-Range'])
+
+        backend.maintain()
+        pack = backend.repo.object_store.packs[0]
+        path = os.path.relpath(pack._data_path, backend.repo.controldir())
+        response = objects_pack_pack(RequestFactory().get('/' + path), backend=backend, path=path, server=server)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(open(pack._data_path, 'rb').read(), ''.join(response))
+        self.assertEqual('"%s"' % pack.data.get_stored_checksum().encode('hex'), response['ETag'])
+
+        server.sendfile = 'x-sendfile'
+        response = objects_pack_pack(RequestFactory().get('/' + path), backend=backend, path=path, server=server)
+        self.assertEqual(os.path.join(backend.repo.controldir(), path), response['X-Sendfile'])
+        self.assertEqual('', response.content)
+
+        backend.delete_repo()
+
+    def test_iter_thread_output(self):
+        import threading
+        from vacuous.backends.dulwich.views import iter_thread_output
+
+        received = threading.Event()
+        def target(write):
+            write('a')
+            # the first chunk reaches the consumer while the thread runs
+            received.wait(5)
+            write('b')
+            write('')
+            write('c')
+        output = iter_thread_output(target)
+        self.assertEqual('a', output.next())
+        received.set()
+        self.assertEqual(['b', 'c'], list(output))
+
+        def failing(write):
+            write('a')
+            raise ValueError("broken")
+        output = iter_thread_output(failing)
+        self.assertEqual('a', output.next())
+        self.assertRaises(ValueError, output.next)
+
+        # writes fail once the consumer went away
+        errors, done = [], threading.Event()
+        def endless(write):
+            try:
+                while True:
+                    write('x')
+            except IOError, e:
+                errors.append(e)
+            done.set()
+        output = iter_thread_output(endless, max_chunks=1)
+        self.assertEqual('x', output.next())
+        output.close()
+        done.wait(5)
+        self.assertEqual(1, len(errors))
+
+    def test_chunk_reader(self):
+        from vacuous.backends.dulwich.views import ChunkReader
+        reader = ChunkReader(iter(['abc', 'de', '', 'fgh']))
+        self.assertEqual('ab', reader.read(2))
+        self.assertEqual('cdef', reader.read(4))
+        self.assertEqual('gh', reader.read())
+        self.assertEqual('', reader.read(1))
+
+    def test_request_body(self):
+        import gzip
+        from StringIO import StringIO
+        from django.test.client import RequestFactory
+        from vacuous.backends.dulwich import views
+
+        data = ''.join('%04x\n' % i for i in xrange(10000))
+        buf = StringIO()
+        f = gzip.GzipFile(fileobj=buf, mode='wb')
+        f.write(data)
+        f.close()
+        body = buf.getvalue()
+        def post(body, **extra):
+            # FakePayload refuses reads past the end of the body
+            extra['wsgi.input'] = StringIO(body)
+            return RequestFactory().post('/git-upload-pack', body, content_type='application/x-git-upload-pack-request', **extra)
+
+        self.assertEqual(data, ''.join(views.iter_request_body(post(data), chunk_size=100)))
+        chunks = list(views.iter_request_body(post(body, HTTP_CONTENT_ENCODING='gzip'), chunk_size=100))
+        self.assertEqual(data, ''.join(chunks))
+        self.assertTrue(max(len(chunk) for chunk in chunks) <= 100)
+
+        max_size, views.MAX_INFLATED_SIZE = views.MAX_INFLATED_SIZE, len(data) - 1
+        try:
+            chunks = views.iter_request_body(post(body, HTTP_CONTENT_ENCODING='gzip'))
+            self.assertRaises(views.RequestBodyTooLarge, list, chunks)
+        finally:
+            views.MAX_INFLATED_SIZE = max_size
+
+    def test_upload_pack(self):
+        import gzip
+        from StringIO import StringIO
+        from django.test.client import RequestFactory
+        from dulwich.protocol import pkt_line
+        from vacuous.backends.dulwich import views
+
+        backend = load_backend('git', self.TEST_REPO)
+        backend.init_repo()
+        backend.write('a.txt', u"a")
+        revision = backend.commit('initial commit')
+        server = views.GitServer()
+        def upload_pack(body, **extra):
+            extra['wsgi.input'] = StringIO(body)
+            request = RequestFactory().post('/git-upload-pack', body, content_type='application/x-git-upload-pack-request', **extra)
+            return views.git_upload_pack(request, backend=backend, server=server)
+
+        # a gzip request body, the pack is streamed
+        buf = StringIO()
+        f = gzip.GzipFile(fileobj=buf, mode='wb')
+        f.write(pkt_line('want %s side-band-64k thin-pack ofs-delta\n' % revision) + pkt_line(None) + pkt_line('done\n'))
+        f.close()
+        opened = []
+        open_repository = views.WebBackend.open_repository
+        views.WebBackend.open_repository = lambda self, backend: opened.append(backend.repo) or backend.repo
+        try:
+            response = upload_pack(buf.getvalue(), HTTP_CONTENT_ENCODING='gzip')
+            self.assertEqual(200, response.status_code)
+            data = ''.join(response)
+        finally:
+            views.WebBackend.open_repository = open_repository
+        self.assertTrue(data.startswith('0008NAK\n'))
+        self.assertTrue('\x01PACK' in data)
+        # the handler thread doesn't share the request thread's repository
+        self.assertEqual(1, len(opened))
+        self.assertFalse(opened[0] is backend.repo)
+
+        # errors in the handler thread reach the response
+        response = upload_pack(pkt_line('want %s side-band-64k thin-pack ofs-delta\n' % ('1' * 40)) + pkt_line(None) + pkt_line('done\n'))
+        self.assertRaises(Exception, ''.join, response)
+
+        max_size, views.MAX_INFLATED_SIZE = views.MAX_INFLATED_SIZE, 10
+        try:
+            self.assertEqual(413, upload_pack(buf.getvalue(), HTTP_CONTENT_ENCODING='gzip').status_code)
+        finally:
+            views.MAX_INFLATED_SIZE = max_size
+
+        backend.delete_repo()
+
+    def test_receive_pack(self):
+        import gzip
+        from StringIO import StringIO
+        from django.http import Http404
+        from django.test.client import RequestFactory
+        from django.utils import simplejson
+        from dulwich.pack import write_pack_objects
+        from dulwich.protocol import pkt_line
+        from vacuous.backends.dulwich import views
+        from vacuous.backends.dulwich.utils import get_spool_dir
+
+        source = load_backend('git', 'foo.git')
+        source.init_repo()
+        source.write('a.txt', u"a")
+        revision = source.commit('initial commit')
+        pack = StringIO()
+        write_pack_objects(pack, [(source.repo.object_store[sha], None) for sha in source.repo.object_store])
+
+        backend = load_backend('git', self.TEST_REPO)
+        backend.init_repo()
+        server = views.GitServer()
+        spool_dir = get_spool_dir(backend.repo)
+        def receive_pack(body, **extra):
+            extra['wsgi.input'] = StringIO(body)
+            # pushes require ssl
+            extra.update({'wsgi.url_scheme': 'https', 'SERVER_PORT': '443'})
+            request = RequestFactory().post('/git-receive-pack', body, content_type='application/x-git-receive-pack-request', **extra)
+            return views.git_receive_pack(request, backend=backend, server=server)
+
+        body = pkt_line('%s %s refs/heads/master\x00report-status\n' % ('0' * 40, revision)) + pkt_line(None) + pack.getvalue()
+        response = receive_pack(body)
+        self.assertEqual(200, response.status_code)
+        self.assertTrue('ok refs/heads/master' in response.content)
+        self.assertEqual(revision, backend.revision(branch='master').revision)
+        self.assertEqual([], os.listdir(spool_dir))
+
+        # the sync ran eagerly, its status is reported by the status view
+        status_url = response['X-Vacuous-Sync-Status']
+        job_id = status_url.rsplit('/', 1)[1]
+        self.assertEqual('https://testserver/sync/%s' % job_id, status_url)
+        response = views.sync_status(RequestFactory().get('/sync/%s' % job_id), backend=backend, job_id=job_id, server=server)
+        status = simplejson.loads(response.content)
+        self.assertEqual(job_id, status['id'])
+        self.assertEqual(self.TEST_REPO, status['repo'])
+        self.assertTrue(status['finished'])
+        self.assertRaises(Http404, views.sync_status, RequestFactory().get('/sync/%s' % job_id), backend=source, job_id=job_id, server=server)
+
+        # the spool is removed when the body is refused
+        max_size, views.MAX_INFLATED_SIZE = views.MAX_INFLATED_SIZE, 10
+        try:
+            buf = StringIO()
+            f = gzip.GzipFile(fileobj=buf, mode='wb')
+            f.write(body)
+            f.close()
+            self.assertEqual(413, receive_pack(buf.getvalue(), HTTP_CONTENT_ENCODING='gzip').status_code)
+        finally:
+            views.MAX_INFLATED_SIZE = max_size
+        self.assertEqual([], os.listdir(spool_dir))
+
+        source.delete_repo()
+        backend.delete_repo()
+
+    def test_refs_etag(self):
+        from django.test.client import RequestFactory
+        from vacuous.backends.dulwich.views import refs_etag
+        backend = load_backend('git', self.TEST_REPO)
+        backend.init_repo()
+        backend.write('a.txt', u"a")
+        backend.commit('initial commit')
+        request = RequestFactory().get('/info/refs')
+        etag = refs_etag(request, backend=backend)
+        self.assertEqual(refs_etag(request, backend=backend), etag)
+        self.assertNotEqual(refs_etag(RequestFactory().get('/info/refs', {'service': 'git-upload-pack'}), backend=backend), etag)
+        backend.write('a.txt', u"b")
+        backend.commit('second commit')
+        self.assertNotEqual(refs_etag(request, backend=backend), etag)
+
+        backend.delete_repo()
+
+    def test_advertisement(self):
+        from django.core.cache import cache
+        from vacuous.backends.dulwich.advertisement import get_advertisement, get_refs_version, render_advertisement
+        backend = load_backend('git', self.TEST_REPO)
+        backend.init_repo()
+        backend.write('a.txt', u"a")
+        r0 = backend.commit('initial commit')
+        etag, data = get_advertisement(backend)
+        self.assertEqual(data, '%s\trefs/heads/master\n' % r0)
+        self.assertEqual(get_advertisement(backend), (etag, data))
+        self.assertTrue('refs/heads/master' in get_advertisement(backend, 'git-upload-pack')[1])
+
+        backend.create_branch('feature')
+        self.assertEqual(get_advertisement(backend)[1], render_advertisement(backend))
+        self.assertTrue('refs/heads/feature' in get_advertisement(backend)[1])
+
+        backend.write('a.txt', u"b")
+        r1 = backend.commit('second commit')
+        self.assertTrue('%s\trefs/heads/master\n' % r1 in get_advertisement(backend)[1])
+        backend.delete_branch('feature')
+        self.assertFalse('refs/heads/feature' in get_advertisement(backend)[1])
+
+        # the version only depends on the refs on disk
+        version = get_refs_version(backend)
+        cache.clear()
+        self.assertEqual(get_refs_version(backend), version)
+        backend.repo.refs['refs/tags/v1'] = r0
+        self.assertNotEqual(get_refs_version(backend), version)
+        self.assertTrue('%s\trefs/tags/v1\n' % r0 in get_advertisement(backend)[1])
+
+        backend.delete_repo()
+
+    def test_pack_cache(self):
+        from vacuous.backends.dulwich import packcache
+        backend = load_backend('git', self.TEST_REPO)
+        backend.init_repo()
+        backend.write('a.txt', u"a")
+        r0 = backend.commit('initial commit')
+        clone = '0032want %s\n00000009done\n' % r0
+        fetch = '0032want %s\n00000032have %s\n0009done\n' % (r0, r0)
+        self.assertEqual(packcache.get_cache_key(backend, fetch), None)
+        key = packcache.get_cache_key(backend, clone)
+        self.assertEqual(packcache.open_cached(backend, key), None)
+
+        self.assertEqual(list(packcache.iter_caching(backend, key, iter(['NAK', 'PACK']))), ['NAK', 'PACK'])
+        self.assertEqual(''.join(packcache.iter_cached(packcache.open_cached(backend, key))), 'NAKPACK')
+
+        backend.write('a.txt', u"b")
+        backend.commit('second commit')
+        new_key = packcache.get_cache_key(backend, clone)
+        self.assertNotEqual(new_key, key)
+        list(packcache.iter_caching(backend, new_key, iter(['NAK'])))
+        # entries for outdated refs are gone
+        self.assertEqual(packcache.open_cached(backend, key), None)
+
+        backend.delete_repo()
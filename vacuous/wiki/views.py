@@ -28,13 +28,20 @@ def view_page(request, slug=None):
     })
     
 
+HISTORY_PAGE_SIZE = 20
+
 def page_history(request, slug=None):
     page = get_object_or_404(Page, slug=slug)
-    history = page.vacuous.history()
+    after = request.GET.get('after', None)
+    # fetch one extra commit to find out whether there are older ones
+    history = page.vacuous.history(after=after, limit=HISTORY_PAGE_SIZE + 1)
+    has_more = len(history) > HISTORY_PAGE_SIZE
+    history = history[:HISTORY_PAGE_SIZE]
 
     return render(request, 'vacuous/wiki/page_history.html', {
         'page': page,
         'history': history,
+        'next_cursor': has_more and history[-1].revision or None,
     })
 
 